@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+    Benchmark of w-sw-ssh.py against the fake devices of ./ssh, no real switch
+    is touched. For each engine and each --thread, it runs w-sw-ssh.py over the
+    same hosts and prints:
+
+        hosts/minute, CPU seconds and peak RSS of w-sw-ssh.py itself
+
+    The fake devices (ssh processes) are not counted in CPU and RSS.
+
+"""
+
+import getopt
+import ipaddress
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+
+def help_and_exit():
+
+    print('''
+Usage:  bench.py <options>
+
+    --hosts <num>               Number of fake devices, default is 200.
+
+    --thread <num,num,...>      Concurrency levels (--thread of w-sw-ssh.py), default is 10,50,100,200.
+
+    --engine <thread,asyncio>   Engines to run, default is thread.
+
+    --latency <seconds>         Seconds for a fake device to answer a command, default is 0.02.
+
+    --lines <num>               Lines of show run / display current-configuration, default is 200.
+
+    --args <"options">          More options of w-sw-ssh.py, such as "--pacing prompt".
+
+    --json <file>               Append the results to <file>, one JSON record per run.
+
+
+Example:
+
+    bench.py --hosts 1000 --thread 100,500,1000 --engine thread,asyncio --args "--pacing prompt"
+
+''')
+    sys.exit()
+
+
+
+def bench_proc(pid):
+
+    # [CPU seconds, peak RSS in KB] of a process by itself, children not included
+    try:
+        with open('/proc/%s/stat' % (pid)) as f_stat:
+            stat = f_stat.read().rsplit(')', 1)[1].split()
+        cpu_time = (int(stat[11]) + int(stat[12])) / os.sysconf('SC_CLK_TCK')
+        rss = 0
+        with open('/proc/%s/status' % (pid)) as f_status:
+            for line in f_status:
+                if line.startswith('VmHWM:'):
+                    rss = int(line.split()[1])
+        return [cpu_time, rss]
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+
+def bench_run(engine, thread, hosts, latency, lines, args):
+
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    tmp_dir = tempfile.mkdtemp(prefix='w-sw-ssh-bench.')
+    ip_first = ipaddress.ip_address('10.0.0.1')
+    cmd = [sys.executable, os.path.join(os.path.dirname(bench_dir), 'w-sw-ssh.py'),
+           '--uid', 'bench', '--pwd', 'bench',
+           '--host', '%s-%s' % (ip_first, ip_first + hosts - 1),
+           '--cmd_prefix', os.path.join(bench_dir, 'bench'),
+           '--log_dir', os.path.join(tmp_dir, 'log'),
+           '--result', os.path.join(tmp_dir, 'result.jsonl'),
+           '--thread', str(thread), '--engine', engine] + shlex.split(args)
+    env = dict(os.environ)
+    env['PATH'] = '%s:%s' % (bench_dir, env.get('PATH', ''))
+    env['FAKE_LATENCY'] = str(latency)
+    env['FAKE_LINES'] = str(lines)
+
+    # CPU and RSS are read from /proc until it exits, the last read is at most 0.1s old
+    start_time = time.time()
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL)
+    usage = [0, 0]
+    while proc.poll() is None:
+        usage = bench_proc(proc.pid) or usage
+        time.sleep(0.1)
+    wall_time = time.time() - start_time
+
+    ok = 0
+    try:
+        with open(os.path.join(tmp_dir, 'result.jsonl')) as f_result:
+            for line in f_result:
+                record = json.loads(line)
+                if record['type'] == 'host' and record['status'] == 'ok':
+                    ok += 1
+    except OSError:
+        pass
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {'engine': engine, 'thread': thread, 'hosts': hosts, 'ok': ok, 'latency': latency, 'lines': lines, 'args': args,
+            'wall': round(wall_time, 3), 'hosts_per_min': round(ok * 60 / wall_time, 1),
+            'cpu': round(usage[0], 2), 'rss_mb': round(usage[1] / 1024, 1)}
+
+
+
+if __name__ == '__main__':
+
+    hosts = 200
+    thread_list = [10, 50, 100, 200]
+    engine_list = ['thread']
+    latency = 0.02
+    lines = 200
+    args = ''
+    json_file = ''
+
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "h", ['hosts=','thread=','engine=','latency=','lines=','args=','json='])
+    except getopt.GetoptError:
+        print("Wrong options!")
+        print("Try '-h' to get more information.")
+        sys.exit(1)
+
+    try:
+        for op, value in opts:
+            if op == '--hosts':
+                hosts = int(value)
+            elif op == '--thread':
+                thread_list = [int(i) for i in value.split(',')]
+            elif op == '--engine':
+                engine_list = value.split(',')
+            elif op == '--latency':
+                latency = float(value)
+            elif op == '--lines':
+                lines = int(value)
+            elif op == '--args':
+                args = value
+            elif op == '--json':
+                json_file = value
+            else:
+                help_and_exit()
+    except ValueError:
+        print('Wrong option: %s %s' % (op, value))
+        print("Try '-h' to get more information.")
+        sys.exit(1)
+
+    print('%s%s%s%s%s%s%s%s' % ('Engine'.ljust(10), 'Thread'.rjust(8), 'Hosts'.rjust(8), 'OK'.rjust(8),
+          'Wall(s)'.rjust(10), 'Hosts/min'.rjust(12), 'CPU(s)'.rjust(10), 'RSS(MB)'.rjust(10)))
+    for engine in engine_list:
+        for thread in thread_list:
+            res = bench_run(engine, thread, hosts, latency, lines, args)
+            print('%s%s%s%s%s%s%s%s' % (engine.ljust(10), str(thread).rjust(8), str(hosts).rjust(8), str(res['ok']).rjust(8),
+                  ('%.2f' % res['wall']).rjust(10), ('%.1f' % res['hosts_per_min']).rjust(12),
+                  ('%.2f' % res['cpu']).rjust(10), ('%.1f' % res['rss_mb']).rjust(10)))
+            sys.stdout.flush()
+            if json_file != '':
+                with open(json_file, 'a') as f_json:
+                    f_json.write('%s\n' % (json.dumps(res, sort_keys=True)))
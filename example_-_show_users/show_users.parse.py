@@ -0,0 +1,100 @@
+"""
+    Parsers of show users / display users for --parse of w-sw-ssh.py:
+
+        w-sw-ssh.py --uid npc -p --host_file ~/ip.test --cmd_prefix ./show_users \
+                    --parse ./show_users.parse.py --parse_dir ./users --parse_format csv
+
+    Rows of all devices go to ./users/<vendor>.users.csv, one row per login
+    user, with ip, port, vendor and cmd of the device.
+
+"""
+
+import re
+
+
+
+def parse_cisco_users(cmd_out):
+
+    #     Line       User       Host(s)              Idle       Location
+    # *  1 vty 0     npc        idle                 00:00:00 localhost
+    rows = list()
+    for line in cmd_out.splitlines():
+        tmp_re = re.search('^(\\*)? *\\d+ +(vty \\d+) +(\\S+) +(.+?) +(\\d+:\\d+:\\d+) *(\\S*)', line)
+        if tmp_re is not None:
+            rows.append({'line': tmp_re.group(2), 'user': tmp_re.group(3), 'idle': tmp_re.group(5),
+                         'location': tmp_re.group(6), 'current': tmp_re.group(1) == '*'})
+    return rows
+
+
+
+def parse_cisco_nexus_users(cmd_out):
+
+    # NAME     LINE         TIME             IDLE          PID COMMENT
+    # npc      pts/0        Nov 28 12:18     .           12345 (172.16.140.12) session=ssh *
+    rows = list()
+    for line in cmd_out.splitlines():
+        tmp_re = re.search('^(\\S+) +(pts/\\d+) +\\w+ +\\d+ +[\\d:]+ +(\\S+) +\\d+ +\\(([^)]*)\\)(.*)', line)
+        if tmp_re is not None:
+            rows.append({'line': tmp_re.group(2), 'user': tmp_re.group(1), 'idle': tmp_re.group(3),
+                         'location': tmp_re.group(4), 'current': tmp_re.group(5).strip().endswith('*')})
+    return rows
+
+
+
+def parse_h3c_users(cmd_out):
+
+    #   Idx UI      Delay    Type Userlevel
+    # + 25  VTY 0   00:00:00 SSH  3
+    #
+    # VTY 0   :
+    #         User name: npc
+    #         Location: 172.16.140.12
+    rows = list()
+    user_info = dict()
+    line_name = ''
+    for line in cmd_out.splitlines():
+        tmp_re = re.search('^([+ ]) *\\d+ +(VTY \\d+) +(\\d+:\\d+:\\d+) +\\S+', line)
+        if tmp_re is not None:
+            rows.append({'line': tmp_re.group(2), 'user': '', 'idle': tmp_re.group(3),
+                         'location': '', 'current': tmp_re.group(1) == '+'})
+            continue
+        tmp_re = re.search('^(VTY \\d+) *:', line)
+        if tmp_re is not None:
+            line_name = tmp_re.group(1)
+            user_info[line_name] = dict()
+            continue
+        tmp_re = re.search('^ +(User name|Location): *(\\S+)', line)
+        if tmp_re is not None and line_name != '':
+            user_info[line_name]['user' if tmp_re.group(1) == 'User name' else 'location'] = tmp_re.group(2)
+    for row in rows:
+        row.update(user_info.get(row['line'], dict()))
+    return rows
+
+
+
+def parse_huawei_users(cmd_out):
+
+    #   User-Intf    Delay    Type   Network Address     AuthenStatus
+    # + 34  VTY 0   00:00:00  SSH    192.168.1.1         pass
+    #         Username : npc
+    rows = list()
+    for line in cmd_out.splitlines():
+        tmp_re = re.search('^([+ ]) *\\d+ +(VTY \\d+) +(\\d+:\\d+:\\d+) +\\S+ +(\\S+)', line)
+        if tmp_re is not None:
+            rows.append({'line': tmp_re.group(2), 'user': '', 'idle': tmp_re.group(3),
+                         'location': tmp_re.group(4), 'current': tmp_re.group(1) == '+'})
+            continue
+        tmp_re = re.search('^ +Username *: *(\\S+)', line)
+        if tmp_re is not None and len(rows) > 0:
+            rows[-1]['user'] = tmp_re.group(1)
+    return rows
+
+
+
+# [vendor or '*', regex of command, table, function]
+w_parser = [
+    ['cisco',       '^sh[a-z]* +users', 'users', parse_cisco_users],
+    ['cisco_nexus', '^sh[a-z]* +users', 'users', parse_cisco_nexus_users],
+    ['h3c',         '^dis?[a-z]* +users', 'users', parse_h3c_users],
+    ['huawei',      '^dis?[a-z]* +users', 'users', parse_huawei_users],
+]
@@ -26,15 +26,42 @@
 
 """
 
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import contextvars
+import csv
+import fcntl
 import getopt
 import getpass
+import hashlib
+import hmac
+import io
+import ipaddress
+import json
+import multiprocessing
 import os
 import pexpect
+import pty
+import queue
 import re
+import resource
+import runpy
+import selectors
+import shlex
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import termios
 import threading
 import time
+import zlib
+
+from pexpect.expect import Expecter, searcher_re, searcher_string
+from pexpect.spawnbase import SpawnBase
 
 
 
@@ -49,9 +76,17 @@ Usage:  %s <options>
 
     -p                          Get password from user input
 
-    --host <ip[:port],...>      ip[:port] list of remote ssh server, default port is 22
+    --host <ip[:port],...>      ip[:port] list of remote ssh server, default port is 22. A host could
+                                also be a subnet, a range or an IPv6 address, see --host_file.
 
-    --host_file <file_name>     File of ip[:port] list
+    --host_file <file_name>     File of ip[:port] list, one host per line. A host could be followed
+                                by its vendor (cisco, cisco_nexus, h3c or huawei) to skip the vendor
+                                detection, and then by its group of --group_rate. # starts a comment,
+                                and duplicated hosts are skipped. For example:
+                                    192.168.161.10:22 h3c tacacs-bj
+                                    192.168.162.0/24            # hosts of a subnet
+                                    192.168.163.10-20:2222 -    # a range, vendor unknown
+                                    [2001:db8::10]:22 huawei
 
     --cmd <cmd1;cmd2;...>       Command list to execute on remote ssh server
 
@@ -61,6 +96,12 @@ Usage:  %s <options>
                                     test.cmd.h3c
                                     test.cmd.huawei
                                 'test' is the prefix (--cmd_prefix).
+                                A command could be followed by options of its own, e.g.
+                                    display current-configuration   #@ timeout=300
+                                    reset counters interface        #@ prompt='\\[Y/N\\]:'
+                                    undo shutdown                   #@ error='^(Error|%% )'
+                                timeout is instead of --timeout, prompt is a regex instead of the
+                                prompt, and the session stops if the output matches error.
 
     --cmd_interval <seconds>    Time to wait after a command being executed, default is 0.5s.
                                 And some devices would get error if execute command too fast.
@@ -71,12 +112,127 @@ Usage:  %s <options>
                                 Example:
                                 /var/log/test/$(date "+%%Y")/$(date "+%%Y%%m%%d")/
 
-    --thread <num>              The maximum threads could be spread each time, default is 1000.
+    --archive <dir>             Instead of a log file per host in --log_dir, the log of each host is
+                                gzip-compressed and appended to a few large segment files in <dir>,
+                                with an index of host -> offset/length in <segment>.idx. A host is
+                                read alone by:
+                                    tail -c +<offset + 1> <segment> | head -c <length> | zcat
+
+    --store <dir>               Store the output of each command once by its sha256, in
+                                <dir>/objects/<2 hex>/<62 hex>.gz, and write a manifest of the run in
+                                <dir>/manifest/ with the sha256 of each host and command, and whether
+                                it's new. An output unchanged since a former run is not written again.
+                                It works with or without --log_dir / --archive.
+
+    --parse <file.py>           Parse the output of each command as soon as it's done, by the parsers
+                                of <file.py> for its vendor and command, in a pool of processes. The
+                                rows are appended to <parse_dir>/<vendor>.<table>.<jsonl|csv> with
+                                ip, port, vendor and cmd. See example_-_show_users/show_users.parse.py.
+
+    --parse_dir <dir>           Directory of the tables of --parse.
+
+    --parse_format <jsonl|csv>  Format of the tables of --parse, default is jsonl.
+
+    --thread <num>              The maximum threads could be running at the same time, default is 1000.
+                                A thread takes the next host as soon as its current host is done.
+                                The limit of open files is raised for it, or it's cut down to the limit.
+
+    --workers <num>             Split the hosts to <num> processes, each runs --thread/<num> sessions
+                                with its own engine, so that more cores and open files could be used.
+                                --result, --journal, --trace, --timing and --vendor_cache are merged.
+                                Default is 1.
 
     --timeout <seconds>         Time to wait for command executing, default is 10 seconds.
                                 Try to set higher value in case of seeing 'pexpect timed out' error.
 
     --l2_sw                     Check the layer-2 switch only infomation, such as uplink, gateway etc.
+                                The gateway MAC is asked once a run for all switches of a gateway, and
+                                the uplink in --vendor_cache is verified by one MAC table lookup.
+
+    --vendor_cache <file>       Cache of vendor and model of each ip:port, a host found in the cache
+                                skips the vendor detection. The entry of a host is dropped when it
+                                expires, or the login banner or prompt of the host was changed.
+
+    --vendor_cache_ttl <sec>    Time to keep an entry of --vendor_cache, default is 604800 (7 days).
+
+    --ssh_mux <path>            Share ssh connections through OpenSSH control sockets in <path>, one
+                                socket per host. A connection is kept after logout for --ssh_persist
+                                seconds, the next run to the same host skips key exchange and login.
+                                Only for devices which accept more than one session on a connection.
+
+    --ssh_persist <seconds>     Time to keep an idle shared connection of --ssh_mux, default is 600.
+
+    --pacing <fixed|prompt>     How commands are paced, default is fixed.
+                                fixed:  wait --cmd_interval before and after each command.
+                                prompt: send the next command as soon as the prompt is back. A device
+                                        showing "too fast" symptoms (lost echo, system busy) gets its
+                                        own gap between commands, doubled each time up to --cmd_interval.
+
+    --result <file>             Write one JSON record per host and per command to <file>, with status,
+                                error, start/end time, and offset/length of the command's output
+                                in the log file of --log_dir.
+
+    --login_rate <num>          Logins per second of the whole run, evenly spaced to protect the AAA
+                                (TACACS+/RADIUS) servers. It doesn't limit sessions in flight (--thread).
+                                Default is 0, no limit.
+
+    --group_rate <num>          Logins per second of each group, the 3rd column of --host_file, or the
+                                /24 (/64 of IPv6) subnet of the host. A host waiting for its group doesn't
+                                take a slot of --thread, hosts of other groups go first. Default is 0,
+                                no limit.
+
+    --precheck <seconds>        TCP connect to the hosts ahead of ssh, up to 1000 at the same time, with
+                                a timeout of <seconds>. A host is handed to ssh as soon as it answers,
+                                unreachable hosts are reported at once and never spawn ssh. Default is
+                                0, no pre-check.
+
+    --retry <num>               Retry a host up to <num> times at the end of the run, if it failed for a
+                                transient reason (ssh, login timeout, no prompt or command timeout).
+                                Default is 0, no retry.
+
+    --retry_wait <seconds>      Wait before the 1st retry of a host, doubled for each next one,
+                                default is 30s.
+
+    --journal <file>            Append the hosts done to <file>, one JSON record per line.
+
+    --resume                    Skip the hosts done well in --journal by a former run.
+
+    --history <file>            Keep the time each host takes in <file> from run to run, and start the
+                                hosts expected to take the longest first. A new host is expected as
+                                the average of its vendor and model. The host list is read at once.
+
+    --timing                    Print p50/p95/p99 of each phase (spawn, login, vendor, command, save,
+                                logout etc.) of all sessions and of each vendor at the end of the run.
+
+    --trace <file>              Write the phases of each session to <file> in Chrome trace format,
+                                it could be opened with chrome://tracing or ui.perfetto.dev.
+
+    --stream                    Write the output of commands to the log file as it's read, only a small
+                                window of it is kept in memory. It's for large outputs such as
+                                show tech-support, and needs --log_dir or --archive.
+
+    --pipeline <num>            Send up to <num> commands ahead without waiting for the prompt of each,
+                                the output is split back at the prompt. It's for high latency links,
+                                and only used if all commands are read-only (show/display).
+
+    --engine <thread|asyncio>   How sessions are driven, default is thread.
+                                thread:  one thread per session, up to --thread threads.
+                                asyncio: all sessions in one event loop, --thread is the maximum
+                                         number of sessions at the same time.
+
+    --record <dir>              Record the byte stream of each session with timing, login and vendor
+                                probes included, to <dir>/<ip>_<port>.jsonl. The password is not
+                                recorded. The gateway MAC of --l2_sw is not shared between sessions,
+                                so that each recording could be replayed on its own.
+
+    --replay <dir>              Feed the sessions from the recordings of --record in <dir> instead of
+                                ssh, no device is touched. The options should be the same as the
+                                recorded run: each send is checked against the recording, and a
+                                session that goes another way fails with error replay. --vendor_cache
+                                is read but never updated.
+
+    --replay_speed <num>        Speed of --replay, 1 is the original speed (default), 2 is twice as
+                                fast, and 0 is as fast as possible.
 
 
 Caution:
@@ -112,58 +268,288 @@ def sys_cmd(str_cmd):
 
 
 
+w_retry_queue = collections.deque()                             # [func_args, retry, not before] to run again
+w_task_arg = contextvars.ContextVar('w_task_arg', default=None)  # [func_args, retry, not before] being run
+
+
+
+def w_requeue(max_retry, retry_wait=0):
+    #
+    # The running func_args runs again at the end of w_threading() or w_asyncio(),
+    # up to max_retry times, and not before retry_wait, 2*retry_wait, 4*retry_wait...
+    # seconds from now.
+    #
+    task = w_task_arg.get()
+    if task is None or task[1] >= max_retry:
+        return False
+    w_retry_queue.append([task[0], task[1] + 1, time.time() + retry_wait * (2 ** task[1])])
+    return True
+
+
+
 def w_threading(func_name, func_args, max_thread):
 
     # multi threading
     if func_name is None or func_name == '':
         print('w_threading() error: func_name is empty.\n')
         return False
-    if func_args is None or not isinstance(func_args, list):
+    if func_args is None or not hasattr(func_args, '__iter__'):
         print('w_threading() error: func_args is wrong.\n')
         return False
-    if not isinstance(max_thread, int) or max_thread is None or max_thread == '':
+    if not isinstance(max_thread, int) or max_thread <= 0:
         max_thread = 1000
 
-    # create thread pool
+    # Sliding window: at most max_thread workers pull their next func_args
+    # from the queue as soon as they are free, so a host hanging until
+    # timeout holds one slot only, instead of stalling a whole round.
+    # The queue is bounded, so func_args (a list or a generator) is consumed
+    # lazily and workers are only created while there is work for them.
+    # The next func_args is only pulled once a worker is free for it, as a
+    # generator could admit a host at that moment (--login_rate).
+    arg_queue = queue.Queue(max_thread)
+    slot_free = threading.Semaphore(max_thread)
+
+    def w_worker():
+        while True:
+            task = arg_queue.get()
+            if task is None:
+                break
+            w_task_arg.set(task)
+            try:
+                func_name(*task[0])
+            except Exception as e:
+                print('[%s] w_threading() error: %s' % (w_time(), e))
+            arg_queue.task_done()
+            slot_free.release()
+
+    def w_task_iter():
+        for args in func_args:
+            yield [args, 0, 0]
+        # func_args requeued by w_requeue(), until no running one could requeue more
+        while True:
+            while len(w_retry_queue) > 0:
+                task = w_retry_queue.popleft()
+                if task[2] > time.time():
+                    time.sleep(task[2] - time.time())
+                yield task
+            arg_queue.join()
+            if len(w_retry_queue) == 0:
+                break
+
+    # start workers on demand and feed them
     thread_pool = list()
-    for i in range(0, len(func_args)):
-        th = threading.Thread(target=func_name, args=func_args[i])
-        thread_pool.append(th)
-
-    # execute threads for max_thread number of threads each time
-    thread_count = len(thread_pool)
-    if thread_count > max_thread:
-        i_begin = 0
-        i_end = 0
-        round_num = int(thread_count / max_thread)
-        if thread_count % max_thread > 0:
-            round_num += 1
-        # max_thread: How many threads (test) could be executed at one time
-        for j in range(0, round_num):
-            i_begin = j * max_thread
-            if j == round_num - 1:                 # the last round
-                i_end = thread_count
-            else:
-                i_end = i_begin + max_thread
-            # start threads
-            for i in range(i_begin, i_end):
-                thread_pool[i].start()
-            # terminate threads
-            for i in range(i_begin, i_end):
-                thread_pool[i].join()
-    # === thread_count <= max_thread ===
-    else:
-        # start threads
-        for i in range(0, thread_count):
-            thread_pool[i].start()
-        # terminate threads
-        for i in range(0, thread_count):
-            thread_pool[i].join()
+    task_iter = w_task_iter()
+    while True:
+        slot_free.acquire()
+        task = next(task_iter, None)
+        if task is None:
+            break
+        if len(thread_pool) < max_thread:
+            th = threading.Thread(target=w_worker)
+            th.start()
+            thread_pool.append(th)
+        arg_queue.put(task)
+    # one stop mark for each worker
+    for th in thread_pool:
+        arg_queue.put(None)
+    for th in thread_pool:
+        th.join()
     # ========== Run threads - End ==========
 #___ End of w_threading() ____
 
 
 
+def w_processing(func_name, func_args, max_process):
+    #
+    # func_name(idx, *func_args) runs in each of max_process forked processes,
+    # idx is 0 .. max_process-1. Their return values are sent back by a queue
+    # and returned in a list, None for a process that failed.
+    #
+    if func_name is None or func_name == '':
+        print('w_processing() error: func_name is empty.\n')
+        return False
+    if not isinstance(max_process, int) or max_process <= 0:
+        max_process = 1
+
+    mp = multiprocessing.get_context('fork')
+    res_queue = mp.Queue()
+
+    def w_process(idx):
+        try:
+            res_queue.put([idx, func_name(idx, *func_args)])
+        except Exception as e:
+            print('[%s] w_processing() error: %s' % (w_time(), e))
+
+    # what is buffered now would be written once more by each process
+    sys.stdout.flush()
+    proc_pool = [mp.Process(target=w_process, args=(i,)) for i in range(0, max_process)]
+    for proc in proc_pool:
+        proc.start()
+    # results are taken before join(), a process can't exit until its queue is read
+    res_list = [None] * max_process
+    res_count = 0
+    while res_count < max_process:
+        try:
+            idx, res = res_queue.get(timeout=1)
+            res_list[idx] = res
+            res_count += 1
+        except queue.Empty:
+            if not any([proc.is_alive() for proc in proc_pool]) and res_queue.empty():
+                break
+    for idx in range(0, max_process):
+        proc_pool[idx].join()
+        if proc_pool[idx].exitcode != 0:
+            print('[%s] w_processing() error: process %s exited with %s.' % (w_time(), idx, proc_pool[idx].exitcode))
+    return res_list
+#___ End of w_processing() ____
+
+
+
+def uf_ssh_cmd(ip, port, uid, opt):
+
+    ssh_cmd = 'ssh -p %s -l %s %s' % (port, uid, ip)
+    if opt.get('ssh_mux', '') != '':
+        # OpenSSH connection sharing, %C is a hash of local host, remote host, port and user
+        ssh_cmd = 'ssh -o ControlMaster=auto -o ControlPath=%s/%%C -o ControlPersist=%s %s' % \
+                    (opt['ssh_mux'], opt.get('ssh_persist', 600), ssh_cmd[4:])
+    return ssh_cmd
+
+
+
+w_login_rate = 0                    # --login_rate, logins per second of the run
+w_group_rate = 0                    # --group_rate, logins per second of each group
+w_login_next = dict()               # group (None for the run) -> time its next login could start
+w_login_lock = threading.Lock()
+w_login_defer = 10000               # hosts put aside by uf_login_feed() at most
+
+
+
+def uf_login_group(ip, hint):
+
+    # the group of --host_file, or the /24 (/64 of IPv6) subnet of the ip
+    if 'group' in hint:
+        return hint['group']
+    try:
+        return str(ipaddress.ip_network('%s/%s' % (ip, 64 if ip.find(':') >= 0 else 24), strict=False))
+    except ValueError:
+        return ip.lower()
+
+
+
+def uf_login_admit(ip, hint, wait=True):
+    #
+    # --login_rate / --group_rate: a login takes a token of the run and one of
+    # its group. Each bucket holds one token, refilled at its rate, so logins
+    # are evenly spaced instead of bursting to the AAA servers as sessions
+    # start. The start time is reserved here, and returned as seconds to wait.
+    # Without wait, nothing is reserved unless the tokens are there now.
+    #
+    if w_login_rate <= 0 and w_group_rate <= 0:
+        return 0
+    group = uf_login_group(ip, hint)
+    with w_login_lock:
+        now = time.time()
+        start_time = now
+        if w_login_rate > 0:
+            start_time = max(start_time, w_login_next.get(None, 0))
+        if w_group_rate > 0:
+            start_time = max(start_time, w_login_next.get(group, 0))
+        if not wait and start_time > now:
+            return start_time - now
+        if w_login_rate > 0:
+            w_login_next[None] = start_time + 1 / w_login_rate
+        if w_group_rate > 0:
+            w_login_next[group] = start_time + 1 / w_group_rate
+    return start_time - now
+
+
+
+def uf_login_feed(func_args):
+    #
+    # Hosts are admitted here, as they're handed to a free slot of --thread /
+    # --async, rather than by a session sleeping in its slot: with the hosts
+    # sorted by subnet, all slots would wait on one group while the others
+    # are idle. A host whose group has no token yet is put aside, and hosts
+    # of other groups go first. A group keeps the order of its hosts.
+    #
+    defer_dict = collections.OrderedDict()  # group -> deque of func_args put aside
+    defer_num = 0
+    arg_iter = iter(func_args)
+    arg_end = False
+    while True:
+        # no host could start before the token of the run
+        if w_login_rate > 0:
+            wait_time = w_login_next.get(None, 0) - time.time()
+            if wait_time > 0:
+                time.sleep(wait_time)
+        if w_group_rate <= 0:
+            args = next(arg_iter, None)
+            if args is None:
+                break
+            uf_login_admit(args[0], args[12] or dict())
+            yield args
+            continue
+        # the first group put aside which has its token now
+        args = None
+        wait_min = None
+        for group in defer_dict:
+            wait_time = uf_login_admit(defer_dict[group][0][0], defer_dict[group][0][12] or dict(), False)
+            if wait_time <= 0:
+                args = defer_dict[group].popleft()
+                if len(defer_dict[group]) == 0:
+                    del defer_dict[group]
+                defer_num -= 1
+                break
+            if wait_min is None or wait_time < wait_min:
+                wait_min = wait_time
+        if args is not None:
+            yield args
+            continue
+        # a new host, unless its group waits already
+        if not arg_end and defer_num < w_login_defer:
+            args = next(arg_iter, None)
+            if args is None:
+                arg_end = True
+                continue
+            group = uf_login_group(args[0], args[12] or dict())
+            if group not in defer_dict and uf_login_admit(args[0], args[12] or dict(), False) <= 0:
+                yield args
+                continue
+            defer_dict.setdefault(group, collections.deque()).append(args)
+            defer_num += 1
+            continue
+        if defer_num == 0:
+            break
+        time.sleep(wait_min)
+
+
+
+#
+# Session flow of both engines:
+#
+# The login / vendor / nomore / command / save / logout steps below are
+# generators, shared by the thread engine and the asyncio engine. Every I/O
+# of a step (expect, read, sleep, spawn, close) is yielded by uf_io() to the
+# driver of the engine, w_drive() or w_drive_async(), which does it with
+# pexpect.spawn or AsyncSpawn and sends the result back, or throws its
+# exception into the step. Sends never block, they're called directly.
+#
+
+def uf_io(ssh, method, *args, **kwargs):
+
+    return (yield (ssh, method, args, kwargs))
+
+
+
+def uf_login_list(ssh):
+
+    login_list = ['(P|p)assword: $', '\(yes/no\)\?', 'Host key verification failed']
+    if ssh.w_mux:
+        login_list.append(uf_prompt_list(ssh)[0])
+    return login_list
+
+
+
 def uf_login_expect(ssh, timeout, f_out):
     #
     #_____ yes/no | password _____
@@ -197,39 +583,110 @@ def uf_login_expect(ssh, timeout, f_out):
     # Host key verification failed.
     # [root@SERVER bin]#
     #
+    #_____ --ssh_mux _____
+    #
+    # No authentication on a shared connection, the prompt comes directly.
+    #
     cmd_out = ''
     try:
-        idx = ssh.expect(['(P|p)assword: $', '\(yes/no\)\?', 'Host key verification failed'], timeout=timeout)
+        idx = yield from uf_io(ssh, 'expect', uf_login_list(ssh), timeout=timeout)
         cmd_out = '%s%s' % (ssh.before, ssh.after)
         if f_out is None:
             print(cmd_out)
         else:
             f_out.write(cmd_out)
         return [idx, cmd_out]
-    except:
+    except Exception:
         return [-1, cmd_out]
 
 
 
-def uf_login_fix_known_hosts(cmd_out):
+w_known_hosts_lock = threading.Lock()
+
+
+
+def uf_known_hosts_match(host_field, host_names):
+
+    # host_field of known_hosts: 192.168.1.1,sw-01 or [192.168.1.1]:2222 or hashed |1|salt|hash
+    if host_field.startswith('|1|'):
+        try:
+            salt, host_hash = host_field[3:].split('|')
+            salt = base64.b64decode(salt)
+            host_hash = base64.b64decode(host_hash)
+        except ValueError:
+            return False
+        for host_name in host_names:
+            if hmac.compare_digest(hmac.new(salt, host_name.encode(), hashlib.sha1).digest(), host_hash):
+                return True
+        return False
+    for host_pattern in host_field.lower().split(','):
+        if host_pattern in host_names:
+            return True
+    return False
 
-    tmp_out = cmd_out.split("\n")
-    for tmp_row in tmp_out:
-        # Offending key in /root/.ssh/known_hosts:2330
-        if re.search('known_hosts:[0-9]+', tmp_row, re.IGNORECASE) is None:
-            continue
-        tmp_row = re.sub('^.* /', '/', tmp_row).strip()
-        tmp_hosts, tmp_line = tmp_row.split(':')
-        tmp_cmd = "sed -i '%sd' %s" % (tmp_line, tmp_hosts)
-        return sys_cmd(tmp_cmd)
-    return ''
+
+
+def uf_login_fix_known_hosts(cmd_out, ip, port):
+    #
+    # Offending RSA key in /root/.ssh/known_hosts:2330
+    #
+    # All keys of the host are removed from the file in-process, under one lock
+    # for all sessions, rather than line 2330 by sed: line numbers are moved by
+    # any fix of another session, and concurrent sed -i lose each other's edit.
+    # The processes of --workers also take a flock of the file itself. As
+    # os.replace() puts a new file in its place, the lock only holds if the
+    # file is still the one at the path once it's taken, or it's taken again.
+    # Returns the number of keys removed.
+    #
+    host_names = ['[%s]:%s' % (ip.lower(), port)]
+    if port == '22':
+        host_names.append(ip.lower())
+    file_list = list()
+    for tmp_file in re.findall('key in (\\S+):[0-9]+', cmd_out, re.IGNORECASE):
+        if tmp_file not in file_list:
+            file_list.append(tmp_file)
+    key_num = 0
+    with w_known_hosts_lock:
+        for tmp_file in file_list:
+            try:
+                while True:
+                    f_lock = open(tmp_file)
+                    fcntl.flock(f_lock, fcntl.LOCK_EX)
+                    if os.fstat(f_lock.fileno()).st_ino == os.stat(tmp_file).st_ino:
+                        break
+                    f_lock.close()
+                with f_lock:
+                    try:
+                        hosts_list = f_lock.readlines()
+                        keep_list = list()
+                        for tmp_row in hosts_list:
+                            tmp_col = tmp_row.split()
+                            if len(tmp_col) > 0 and tmp_col[0].startswith('@'):
+                                tmp_col = tmp_col[1:]       # @cert-authority, @revoked
+                            if len(tmp_col) > 0 and uf_known_hosts_match(tmp_col[0], host_names):
+                                key_num += 1
+                                continue
+                            keep_list.append(tmp_row)
+                        if len(keep_list) == len(hosts_list):
+                            continue
+                        f_hosts = open('%s.w-sw-ssh' % (tmp_file), 'w')
+                        f_hosts.writelines(keep_list)
+                        f_hosts.close()
+                        os.chmod('%s.w-sw-ssh' % (tmp_file), os.stat(tmp_file).st_mode & 0o777)
+                        os.replace('%s.w-sw-ssh' % (tmp_file), tmp_file)
+                    finally:
+                        fcntl.flock(f_lock, fcntl.LOCK_UN)
+            except OSError as e:
+                print('[%s] %s:%s Error: %s is failed to fix, %s' % (w_time(), ip, port, tmp_file, e))
+    return key_num
 
 
 
 def uf_login_send_yes(ssh, sleep_time):
 
     ssh.sendline('yes')
-    time.sleep(sleep_time)
+    if ssh.w_pacing == 'fixed':
+        yield from uf_io(None, 'sleep', sleep_time)
     return True
 
 
@@ -237,7 +694,8 @@ def uf_login_send_yes(ssh, sleep_time):
 def uf_login_send_pwd(ssh, sleep_time, pwd):
 
     ssh.sendline(pwd)
-    time.sleep(sleep_time)
+    if ssh.w_pacing == 'fixed':
+        yield from uf_io(None, 'sleep', sleep_time)
     return True
 
 
@@ -251,28 +709,38 @@ def uf_ssh_login(ssh, timeout, output_file, f_out, ip, port, uid, pwd, sleep_tim
     #   uf_login_send_yes()
     #   uf_login_send_pwd()
     # 
-    idx, cmd_out = uf_login_expect(ssh, timeout, f_out)             # login expect
+    idx, cmd_out = yield from uf_login_expect(ssh, timeout, f_out)  # login expect
     # login error
     if idx == -1:
         print('[%s] %s:%s Error: uid <%s> login failed (1)' % (w_time(), ip, port, uid))
+        ssh.w_login_error = 'login_eof' if ssh.flag_eof else 'login_timeout'
         return False
-    # wrong known_hosts
+    # already authenticated (--ssh_mux), ask for a new prompt
+    if idx == 3:
+        ssh.w_login_out = cmd_out
+        ssh.sendline('')
+        return True
+    # wrong known_hosts, the session could be requeued by w_requeue()
     if idx == 2:
-        uf_login_fix_known_hosts(cmd_out) 
-        print('[%s] %s:%s Error: Host key was fixed and try again.' % (w_time(), ip, port))
+        if uf_login_fix_known_hosts(cmd_out, ip, port) > 0:
+            print('[%s] %s:%s Error: Host key was fixed and try again.' % (w_time(), ip, port))
+            ssh.w_login_error = 'known_hosts'
+        else:
+            print('[%s] %s:%s Error: Host key verification failed.' % (w_time(), ip, port))
+            ssh.w_login_error = 'host_key'
         return False
     # ask for yes/no
     if idx == 1:
-        uf_login_send_yes(ssh, sleep_time)
-        idx, cmd_out = uf_login_expect(ssh, timeout, f_out)         # login expect
+        yield from uf_login_send_yes(ssh, sleep_time)
+        idx, cmd_out = yield from uf_login_expect(ssh, timeout, f_out)  # login expect
     # ask for password
     if idx == 0:
-        uf_login_send_pwd(ssh, sleep_time, pwd)
+        yield from uf_login_send_pwd(ssh, sleep_time, pwd)
     return True
 
 
 
-def uf_expect_prompt(ssh, timeout, f_out):
+def uf_prompt_list(ssh):
     #
     # Prompt:
     #
@@ -290,27 +758,373 @@ def uf_expect_prompt(ssh, timeout, f_out):
     # Q: Why put a . next to \\n)?
     # A: Some devices output a prompt likes ^@<BJ_XX_311_F-12-13_LVS_S5560>
     #
+    # Once a prompt was matched, the session learns it, e.g. <BJ_XX_305-A-15_CE5810>,
+    # and matches that literal first. The generic prompt is the fallback for
+    # a changed prompt, such as [~BJ_XX_305-A-15_CE5810] in system-view.
+    #
     prompt = "(\\r|\\n).?[<>a-zA-Z0-9~@\*/_\-\[\]\(\)]+(>|%|#|\\$|\]) *$"
+    if ssh.w_step_prompt is not None:
+        return [ssh.w_step_prompt, pexpect.TIMEOUT]        # prompt= of the command, see uf_cmd_plan()
+    if ssh.w_prompt_re is None:
+        return [prompt, pexpect.TIMEOUT]
+    return [ssh.w_prompt_re, prompt, pexpect.TIMEOUT]
+
+
+
+def uf_prompt_learn(ssh, idx, prompt_list):
+
+    # returns 0 for any prompt and 1 for timeout, as uf_expect_prompt() always did
+    if prompt_list[idx] is pexpect.TIMEOUT:
+        return 1
+    if prompt_list[idx] is ssh.w_step_prompt:
+        return 0
+    if prompt_list[idx] is not ssh.w_prompt_re:
+        tmp_re = re.search('[<>a-zA-Z0-9~@\*/_\-\[\]\(\)]+(>|%|#|\\$|\]) *$', ssh.after)
+        if tmp_re is not None:
+            ssh.w_prompt = tmp_re.group(0).strip()
+            ssh.w_prompt_re = re.compile('(\r|\n).?%s *$' % (re.escape(ssh.w_prompt)))
+    return 0
+
+
+
+#
+# Pager, if no-more was rejected (e.g. a restricted AAA role) or missed:
+#
+#       "  ---- More ----" + "\x1b[16D                \x1b[16D"     H3C, Huawei
+#       " --More-- " + "\b\b\b...        \b\b\b..."                  Cisco
+#
+# A space is sent for the next page, and the pager and its erase sequence
+# are stripped from the output.
+#
+w_pager_re = re.compile(' *(---- More ----|--More--|<--- More --->) *$')
+w_pager_list = ['---- More ----', '--More--', '<--- More --->']
+w_pager_erase_re = re.compile('\x1b\\[[0-9]+D *\x1b\\[[0-9]+D|\x1b\\[[0-9]+D|\x08+ *\x08*')
+
+
+
+def uf_pager_strip(cmd_out):
+
+    return w_pager_erase_re.sub('', cmd_out)
+
+
+
+def uf_nomore_rejected(ssh, cmd_out):
+
+    # the pager is answered by uf_expect_prompt() then, but --pipeline can't be used
+    #
+    #   % Permission denied.
+    #   % Screen-length configuration is disabled for current user.        H3C
+    #
+    if uf_vendor_wrong(cmd_out) or re.search('[Pp]ermission|[Dd]enied|[Dd]isabled|Error:', cmd_out) is not None:
+        print('[%s] %s:%s Warning: no-more was rejected, the pager is answered by space.' % (w_time(), ssh.w_ip, ssh.w_port))
+        ssh.w_pager = True
+
+
+
+def uf_expect_prompt(ssh, timeout, f_out):
+
+    # Only the tail (ssh.w_window) of the output is searched, not the whole
+    # output again after every read, which is slow for show run etc.
+    if ssh.w_stream and f_out is not None:
+        return (yield from uf_expect_stream(ssh, timeout, f_out))
+    prompt_list = uf_prompt_list(ssh)
     cmd_out = ''
     try:
-        idx = ssh.expect([prompt, pexpect.TIMEOUT], timeout=timeout)
-        cmd_out = '%s%s' % (ssh.before, ssh.after)
+        end_time = time.time() + timeout
+        pages = 0
+        while True:
+            idx = yield from uf_io(ssh, 'expect', [w_pager_re] + prompt_list, timeout=max(end_time - time.time(), 0), searchwindowsize=ssh.w_window)
+            if idx > 0:
+                break
+            cmd_out += ssh.before
+            ssh.send(' ')
+            pages += 1
+        cmd_out = '%s%s' % (uf_pager_strip(cmd_out + ssh.before) if pages > 0 else ssh.before, ssh.after)
+        idx -= 1
         if f_out is None:
             print(cmd_out)
         else:
             f_out.write(cmd_out)
-        return [idx, cmd_out]
-    except:
+        return [uf_prompt_learn(ssh, idx, prompt_list), cmd_out]
+    except Exception:
         return [-1, cmd_out]
 
 
 
+def uf_stream_init(ssh):
+
+    prompt_list = uf_prompt_list(ssh)
+    prompt_re = list()
+    for prompt in prompt_list[:-1]:
+        if isinstance(prompt, str):
+            prompt = re.compile(prompt, re.DOTALL)
+        prompt_re.append(prompt)
+    return {'list': prompt_list, 're': prompt_re, 'head': '', 'tail': '', 'pages': 0}
+
+
+
+def uf_stream_feed(ssh, f_out, stream, data):
+    #
+    # --stream: the output is written to the log as it's read, only the head
+    # and the tail (ssh.w_window each) are kept in memory. The tail is where
+    # the prompt is searched. Returns the index in stream['list'] of the
+    # matched prompt, or None.
+    #
+    tail = stream['tail'] + data
+    if stream['pages'] > 0:
+        tail = uf_pager_strip(tail)
+    tmp_re = w_pager_re.search(tail)
+    if tmp_re is not None:
+        tail = tail[:tmp_re.start()]
+        ssh.send(' ')
+        stream['pages'] += 1
+    for i in range(0, len(stream['re'])):
+        tmp_re = stream['re'][i].search(tail)
+        if tmp_re is not None:
+            f_out.write(tail[:tmp_re.end()])
+            ssh.buffer = tail[tmp_re.end():]
+            ssh.before = tail[:tmp_re.start()]
+            ssh.after = tmp_re.group(0)
+            stream['tail'] = tail[:tmp_re.end()]
+            return i
+    if len(tail) > ssh.w_window:
+        flush = tail[:-ssh.w_window]
+        f_out.write(flush)
+        if len(stream['head']) < ssh.w_window:
+            stream['head'] += flush[:ssh.w_window - len(stream['head'])]
+        tail = tail[-ssh.w_window:]
+    stream['tail'] = tail
+    return None
+
+
+
+def uf_expect_stream(ssh, timeout, f_out):
+
+    # returns [idx, cmd_out] as uf_expect_prompt(), cmd_out is the head and the tail only
+    stream = uf_stream_init(ssh)
+    data = ssh.buffer
+    ssh.buffer = ''
+    end_time = time.time() + timeout
+    while True:
+        idx = uf_stream_feed(ssh, f_out, stream, data)
+        if idx is not None:
+            return [uf_prompt_learn(ssh, idx, stream['list']), stream['head'] + stream['tail']]
+        try:
+            wait_time = end_time - time.time()
+            if wait_time <= 0:
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            data = yield from uf_io(ssh, 'read', wait_time)
+        except pexpect.TIMEOUT:
+            f_out.write(stream['tail'])
+            return [1, stream['head'] + stream['tail']]
+        except Exception:
+            f_out.write(stream['tail'])
+            return [-1, stream['head'] + stream['tail']]
+
+
+
+def uf_session_init(ssh, ip, port, opt):
+    #
+    # Per-session state is kept on the spawn object, so that it's shared by
+    # all uf_* functions of both engines without changing their arguments.
+    #
+    ssh.w_ip = ip
+    ssh.w_port = port
+    ssh.w_pacing = opt.get('pacing', 'fixed')
+    ssh.w_gap = 0                   # adaptive gap of --pacing prompt
+    ssh.w_last = time.time()        # when the last prompt was seen
+    ssh.w_prompt = ''               # prompt learned by uf_prompt_learn()
+    ssh.w_prompt_re = None
+    ssh.w_window = 512              # bytes at the end of output to search for prompt
+    ssh.w_mux = opt.get('ssh_mux', '') != ''
+    ssh.w_login_out = ''            # banner got by uf_login_expect() on a shared connection
+    ssh.w_stream = False            # set by w_main() for the commands of --stream
+    ssh.w_login_error = ''          # why uf_ssh_login() failed, see w_retry_error
+    ssh.w_step_prompt = None        # prompt= of the command being executed
+    ssh.w_step_answer = False       # the last command stopped at its prompt=, the next line answers it
+    ssh.w_pager = False             # no-more was rejected, see uf_nomore_rejected()
+    # pexpect.spawn sleeps 0.05s before every send, the very dead time that
+    # --pacing prompt and --pipeline remove. AsyncSpawn never sleeps there.
+    if ssh.w_pacing == 'prompt' or opt.get('pipeline', 0) > 0:
+        ssh.delaybeforesend = None
+    return ssh
+
+
+
+def uf_pace_wait(ssh):
+
+    # time left of the device's own gap since its last prompt
+    wait_time = ssh.w_gap - (time.time() - ssh.w_last)
+    if wait_time > 0:
+        return wait_time
+    return 0
+
+
+
+def uf_pace_check(ssh, sleep_time, content, idx, cmd_out):
+    #
+    # Symptoms of sending too fast:
+    #
+    #   - the command was not echoed completely, some characters were lost
+    #   - % The system is busy, please try again later.
+    #
+    # The gap of the device starts from 0 and is doubled on each symptom,
+    # up to --cmd_interval.
+    #
+    ssh.w_last = time.time()
+    if idx != 0:
+        return ssh.w_gap
+    too_fast = False
+    cmd_echo = re.sub('\s+', '', content)[:40]
+    if cmd_echo != '' and re.sub('\s+', '', cmd_out).find(cmd_echo) < 0:
+        too_fast = True
+    if re.search('system is busy|try again later|too (fast|frequent)|is being executed', cmd_out, re.IGNORECASE) is not None:
+        too_fast = True
+    if too_fast and ssh.w_gap < sleep_time:
+        ssh.w_gap = min(sleep_time, max(0.05, ssh.w_gap * 2))
+        print('[%s] %s:%s Warning: device is too slow to take commands, gap is raised to %ss.' % (w_time(), ssh.w_ip, ssh.w_port, ssh.w_gap))
+    return ssh.w_gap
+
+
+
 def uf_expect_sendline(ssh, timeout, f_out, sleep_time, content):
 
-    ssh.sendline('')
+    # --pacing prompt: send as soon as the device gave its prompt back,
+    # multi-line content (save, logout) still takes the fixed sleep.
+    if ssh.w_pacing == 'prompt' and content.find('\r') < 0:
+        wait_time = uf_pace_wait(ssh)
+        if wait_time > 0:
+            yield from uf_io(None, 'sleep', wait_time)
+        ssh.sendline(content)
+        idx, cmd_out = yield from uf_expect_prompt(ssh, timeout, f_out)
+        uf_pace_check(ssh, sleep_time, content, idx, cmd_out)
+        return [idx, cmd_out]
+    # no empty line ahead of the answer to a prompt=, [Y/N]: would take it
+    if not ssh.w_step_answer:
+        ssh.sendline('')
+    ssh.w_step_answer = False
     ssh.sendline(content)
-    time.sleep(sleep_time)
-    return uf_expect_prompt(ssh, timeout, f_out)
+    yield from uf_io(None, 'sleep', sleep_time)
+    return (yield from uf_expect_prompt(ssh, timeout, f_out))
+
+
+
+def uf_pipeline_ok(ssh, opt, cmd_plan):
+
+    # only read-only commands could be typed ahead of the former one's output
+    if opt.get('pipeline', 0) <= 0 or ssh.w_prompt == '':
+        return False
+    if ssh.w_pager:
+        print('[%s] %s:%s Warning: the pager is on, --pipeline is ignored.' % (w_time(), ssh.w_ip, ssh.w_port))
+        return False
+    for cmd_line, cmd_timeout, cmd_prompt, cmd_error in cmd_plan:
+        if cmd_prompt is not None:
+            print('[%s] %s:%s Warning: "%s" has its own prompt, --pipeline is ignored.' % (w_time(), ssh.w_ip, ssh.w_port, cmd_line))
+            return False
+        if cmd_line != '' and re.search('^(sh|sho|show|dis|disp|displ|displa|display)(\\s|$)', cmd_line, re.IGNORECASE) is None:
+            print('[%s] %s:%s Warning: "%s" is not read-only, --pipeline is ignored.' % (w_time(), ssh.w_ip, ssh.w_port, cmd_line))
+            return False
+    return True
+
+
+
+def uf_expect_pipeline(ssh, timeout, f_out, cmd_plan, window, i, cmd_sent):
+    #
+    # Up to <window> commands are sent before their outputs come back, the
+    # device echoes a typed-ahead command after the prompt of the former:
+    #
+    #   <BJ_XX_305-A-15_CE5810>display users
+    #   ...
+    #   <BJ_XX_305-A-15_CE5810>display clock
+    #   ...
+    #   <BJ_XX_305-A-15_CE5810>
+    #
+    # so the stream is split at each learned prompt, which is searched
+    # as a plain string in the new data only. Returns [idx, cmd_out] of the
+    # i-th command, idx is 0 for prompt and 1 for timeout. cmd_sent is
+    # [number of commands sent so far], kept by the caller.
+    #
+    # A pager, missed by uf_nomore_rejected(), eats the commands sent ahead
+    # as its keys: the pages are answered and the output is drained until
+    # the device is quiet, and idx is 3, the caller runs the rest one by one.
+    #
+    while cmd_sent[0] < len(cmd_plan) and cmd_sent[0] < i + window:
+        ssh.sendline(cmd_plan[cmd_sent[0]][0])
+        cmd_sent[0] += 1
+    cmd_out = ''
+    try:
+        idx = yield from uf_io(ssh, 'expect_exact', [ssh.w_prompt, pexpect.TIMEOUT] + w_pager_list, timeout=cmd_plan[i][1] or timeout)
+        cmd_out = '%s%s' % (ssh.before, ssh.after)
+        if f_out is None:
+            print(cmd_out)
+        else:
+            f_out.write(cmd_out)
+        if idx >= 2:
+            print('[%s] %s:%s Warning: the pager is on, --pipeline is stopped.' % (w_time(), ssh.w_ip, ssh.w_port))
+            ssh.w_pager = True
+            while idx != 1:
+                if idx >= 2:
+                    ssh.send(' ')
+                idx = yield from uf_io(ssh, 'expect_exact', [ssh.w_prompt, pexpect.TIMEOUT] + w_pager_list, timeout=min(timeout, 2))
+                if f_out is None:
+                    print('%s%s' % (ssh.before, ssh.after if idx != 1 else ''))
+                else:
+                    f_out.write('%s%s' % (ssh.before, ssh.after if idx != 1 else ''))
+            idx = 3
+    except Exception:
+        idx = -1
+    ssh.w_last = time.time()
+    return [idx, cmd_out]
+
+
+
+def uf_get_vendor(cmd_out):
+
+    vendor = ''
+    # h3c or huawei devices
+    if cmd_out.find('H3C ') >= 0:
+        vendor = '%s%s' % (vendor, 'h3c')
+    if cmd_out.find('Huawei ') >= 0:
+        vendor = '%s%s' % (vendor, 'huawei')
+    if vendor != '':
+        return vendor
+    # cisco devices
+    if cmd_out.find('Cisco Nexus ') >= 0:
+        vendor = 'cisco_nexus'
+    elif cmd_out.find('Cisco ') >= 0:
+        vendor = 'cisco'
+    return vendor
+
+
+
+def uf_get_model(cmd_out, vendor):
+
+    model = ''
+    reg_vendor_search = ''
+    reg_vendor_sub = ''
+    if vendor.endswith('h3c'):
+        reg_vendor_search = '^h3c.*uptime'
+        reg_vendor_sub = ' *uptime.*$'
+    if vendor.endswith('huawei'):
+        reg_vendor_search = '^huawei.*uptime'
+        reg_vendor_sub = ' *uptime.*$'
+    if vendor == 'cisco_nexus':
+        reg_vendor_search = '^cisco.*chassis'
+        reg_vendor_sub = ' *(\(|chassis).*$'
+    if vendor == 'cisco':
+        reg_vendor_search = '^cisco.*processor'
+        reg_vendor_sub = ' *(\(|chassis).*$'
+    tmp_row = ''
+    tmp_out = cmd_out.split('\n')
+    for tmp_row in tmp_out:
+        tmp_row = tmp_row.strip()
+        if re.search(reg_vendor_search, tmp_row, re.IGNORECASE) is None:
+            continue
+        else:
+            model = re.sub(reg_vendor_sub, '', tmp_row, re.IGNORECASE)
+            model = re.sub('^(cisco nexus|cisco|h3c|huawei) *', '', model, re.IGNORECASE)
+            break 
+    return model
 
 
 
@@ -320,55 +1134,139 @@ def uf_get_vendor_model(ssh, timeout, f_out, sleep_time):
     model   = ''
     cmd_out = ''
     #___ Get vendor ___
-    reg_vendor_search = ''
-    reg_vendor_sub = ''
     # 1st, for h3c or huawei devices
     tmp_cmd = 'display version | in (Huawei|H3C).*(Software|uptime)'
-    idx, cmd_out = uf_expect_sendline(ssh, timeout, f_out, sleep_time, tmp_cmd)
+    idx, cmd_out = yield from uf_expect_sendline(ssh, timeout, f_out, sleep_time, tmp_cmd)
     if idx == 1:
-        print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
+        print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ssh.w_ip, ssh.w_port))
         return [vendor, model]
     if re.search('% Invalid|Unrecognized command', cmd_out) is None:
-        if cmd_out.find('H3C ') >= 0:
-            vendor = '%s%s' % (vendor, 'h3c')
-            reg_vendor_search = '^h3c.*uptime'
-            reg_vendor_sub = ' *uptime.*$'
-        if cmd_out.find('Huawei ') >= 0:
-            vendor = '%s%s' % (vendor, 'huawei')
-            reg_vendor_search = '^huawei.*uptime'
-            reg_vendor_sub = ' *uptime.*$'
+        vendor = uf_get_vendor(cmd_out)
     # 2nd, for cisco devices
     else:
         tmp_cmd = 'show version | in Cisco.*Software|cisco.*(Chassis|processor)'
-        idx, cmd_out = uf_expect_sendline(ssh, timeout, f_out, sleep_time, tmp_cmd)
+        idx, cmd_out = yield from uf_expect_sendline(ssh, timeout, f_out, sleep_time, tmp_cmd)
         if idx == 1:
-            print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
+            print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ssh.w_ip, ssh.w_port))
             return [vendor, model]
-        if cmd_out.find('Cisco Nexus ') >= 0:
-            vendor = 'cisco_nexus'
-            reg_vendor_search = '^cisco.*chassis'
-            reg_vendor_sub = ' *(\(|chassis).*$'
-        elif cmd_out.find('Cisco ') >= 0:
-            vendor = 'cisco'
-            reg_vendor_search = '^cisco.*processor'
-            reg_vendor_sub = ' *(\(|chassis).*$'
+        vendor = uf_get_vendor(cmd_out)
     #___ Get model ___
-    tmp_row = ''
-    tmp_out = cmd_out.split('\n')
-    for tmp_row in tmp_out:
-        tmp_row = tmp_row.strip()
-        if re.search(reg_vendor_search, tmp_row, re.IGNORECASE) is None:
-            continue
-        else:
-            model = re.sub(reg_vendor_sub, '', tmp_row, re.IGNORECASE)
-            model = re.sub('^(cisco nexus|cisco|h3c|huawei) *', '', model, re.IGNORECASE)
-            break 
+    model = uf_get_model(cmd_out, vendor)
     # Return
     return [vendor, model]
 
 
 
-def uf_set_nomore(ssh, timeout, f_out, sleep_time, vendor):
+w_vendor_cache = dict()             # ip:port -> {vendor, model, prompt, banner, time}, and
+                                    # {gw_ip, gw_mac, l2_uplink, l2_time} of --l2_sw
+w_vendor_cache_del = set()          # ip:port deleted by this process, for uf_run_merge()
+w_vendor_cache_lock = threading.Lock()
+
+
+
+def uf_vendor_cache_load(file_name):
+
+    global w_vendor_cache
+    if not os.path.exists(file_name):
+        return w_vendor_cache
+    try:
+        f_cache = open(file_name)
+        w_vendor_cache = json.load(f_cache)
+        f_cache.close()
+    except:
+        print('[%s] Warning: %s is not a vendor cache, ignored.' % (w_time(), file_name))
+        w_vendor_cache = dict()
+    return w_vendor_cache
+
+
+
+def uf_vendor_cache_save(file_name):
+
+    # write a new file then rename, a broken run never leaves half a cache behind
+    with w_vendor_cache_lock:
+        try:
+            f_cache = open('%s.tmp' % (file_name), 'w')
+            json.dump(w_vendor_cache, f_cache, indent=1, sort_keys=True)
+            f_cache.close()
+            os.replace('%s.tmp' % (file_name), file_name)
+        except:
+            print('[%s] Error: vendor cache %s is failed to save.' % (w_time(), file_name))
+            return False
+    return True
+
+
+
+def uf_banner_digest(cmd_out, prompt):
+    #
+    # Digest of the login banner, lines with "Last login" and all digits
+    # are ignored because they change from one login to another.
+    #
+    tmp_out = list()
+    for tmp_row in cmd_out.split('\n'):
+        if tmp_row.strip() == prompt:
+            continue
+        if re.search('last login', tmp_row, re.IGNORECASE) is not None:
+            continue
+        tmp_row = re.sub('[0-9\s]+', '', tmp_row)
+        if tmp_row != '':
+            tmp_out.append(tmp_row)
+    return hashlib.md5('\n'.join(tmp_out).encode('utf-8')).hexdigest()
+
+
+
+def uf_vendor_known(ip, port, hint, opt, prompt, banner):
+    #
+    # Vendor and model known before login:
+    #
+    #   1st, vendor column of --host_file
+    #   2nd, --vendor_cache, unless expired, or banner or prompt changed
+    #
+    vendor = hint.get('vendor', '')
+    model = ''
+    if opt.get('vendor_cache', '') == '':
+        return [vendor, model]
+    host_key = '%s:%s' % (ip, port)
+    with w_vendor_cache_lock:
+        cache = w_vendor_cache.get(host_key)
+        if cache is None:
+            return [vendor, model]
+        if time.time() - cache['time'] > opt.get('vendor_cache_ttl', 604800) or \
+            cache['prompt'] != prompt or cache['banner'] != banner:
+            del w_vendor_cache[host_key]
+            w_vendor_cache_del.add(host_key)
+            return [vendor, model]
+    if vendor == '' or vendor == cache['vendor']:
+        vendor = cache['vendor']
+        model = cache['model']
+    return [vendor, model]
+
+
+
+def uf_vendor_cache_set(ip, port, opt, vendor, model, prompt, banner):
+
+    # a replay never changes the cache, the next replay takes the same path
+    if opt.get('vendor_cache', '') == '' or w_replay_dir != '':
+        return False
+    host_key = '%s:%s' % (ip, port)
+    with w_vendor_cache_lock:
+        if vendor == '':
+            w_vendor_cache.pop(host_key, None)
+            w_vendor_cache_del.add(host_key)
+        else:
+            w_vendor_cache[host_key] = {'vendor': vendor, 'model': model, 'prompt': prompt, 'banner': banner, 'time': int(time.time())}
+            w_vendor_cache_del.discard(host_key)
+    return True
+
+
+
+def uf_vendor_wrong(cmd_out):
+
+    # the known vendor is wrong if the device does not take its no-more command
+    return re.search('% Invalid|Unrecognized command', cmd_out) is not None
+
+
+
+def uf_cmd_nomore(vendor):
 
     cmd_nomore = ''
     if vendor == 'cisco':
@@ -379,11 +1277,17 @@ def uf_set_nomore(ssh, timeout, f_out, sleep_time, vendor):
         cmd_nomore = 'screen-length disable'
     if vendor == 'huawei':
         cmd_nomore = 'screen-length 0 temp'
-    return uf_expect_sendline(ssh, timeout, f_out, sleep_time, cmd_nomore)
+    return cmd_nomore
 
 
 
-def uf_save(ssh, timeout, f_out, sleep_time, vendor):
+def uf_set_nomore(ssh, timeout, f_out, sleep_time, vendor):
+
+    return (yield from uf_expect_sendline(ssh, timeout, f_out, sleep_time, uf_cmd_nomore(vendor)))
+
+
+
+def uf_cmd_save(vendor):
 
     cmd_save = ''
     if vendor == 'cisco':
@@ -394,11 +1298,17 @@ def uf_save(ssh, timeout, f_out, sleep_time, vendor):
         cmd_save = 'save force'
     if vendor == 'huawei':
         cmd_save = 'return\rsave\r\y\r'
-    return uf_expect_sendline(ssh, timeout, f_out, sleep_time, cmd_save)
+    return cmd_save
 
 
 
-def uf_logout(ssh, timeout, f_out, sleep_time, vendor):
+def uf_save(ssh, timeout, f_out, sleep_time, vendor):
+
+    return (yield from uf_expect_sendline(ssh, timeout, f_out, sleep_time, uf_cmd_save(vendor)))
+
+
+
+def uf_cmd_logout(vendor):
 
     cmd_logout = ''
     if vendor == 'cisco':
@@ -409,23 +1319,21 @@ def uf_logout(ssh, timeout, f_out, sleep_time, vendor):
         cmd_logout = 'quit\rquit\r'
     if vendor == 'huawei':
         cmd_logout = 'quit\rquit\r'
-    return uf_expect_sendline(ssh, timeout, f_out, sleep_time, cmd_logout)
+    return cmd_logout
+
 
 
+def uf_logout(ssh, timeout, f_out, sleep_time, vendor):
+
+    return (yield from uf_expect_sendline(ssh, timeout, f_out, sleep_time, uf_cmd_logout(vendor)))
+
 
-def uf_get_l2_uplink(ssh, timeout, f_out, sleep_time, vendor):
 
-    l2_uplink         = ''
-    gw_ip             = ''
-    gw_mac            = ''
+def uf_cmd_l2_uplink(vendor):
+
     cmd_get_gw_ip     = ''
     cmd_get_gw_mac    = ''
     cmd_get_gw_uplink = ''
-    reg_get_gw_ip_search  = '\s?[1-9]\d{0,2}(\.\d{1,3}){3}\s?'           # match ip but not 0.0.0.0
-    reg_get_gw_mac_search = '\s?([\da-f]{4}[\.-]){2}[\da-f]{4}\s?'
-    reg_get_gw_uplink_sub = ''
-
-    # Init cmd
     if vendor == 'cisco':
         cmd_get_gw_ip     = 'show ip default-gateway'
         cmd_get_gw_mac    = 'show ip arp _IP_'
@@ -442,14 +1350,14 @@ def uf_get_l2_uplink(ssh, timeout, f_out, sleep_time, vendor):
         cmd_get_gw_ip     = 'display ip routing-table 0.0.0.0 0'
         cmd_get_gw_mac    = 'disp arp dynamic | include _IP_'
         cmd_get_gw_uplink = 'display mac-address _MAC_'
+    return [cmd_get_gw_ip, cmd_get_gw_mac, cmd_get_gw_uplink]
 
-    # Get gateway IP
-    idx, cmd_out = uf_expect_sendline(ssh, timeout, f_out, sleep_time, cmd_get_gw_ip)
-    if idx == 1:
-        print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
-        return l2_uplink
-    if idx == -1:
-        return l2_uplink
+
+
+def uf_get_gw_ip(cmd_out):
+
+    gw_ip = ''
+    reg_get_gw_ip_search  = '\s?[1-9]\d{0,2}(\.\d{1,3}){3}\s?'           # match ip but not 0.0.0.0
     tmp_row = ''
     tmp_out = cmd_out.split('\n')
     for tmp_row in tmp_out:
@@ -460,17 +1368,14 @@ def uf_get_l2_uplink(ssh, timeout, f_out, sleep_time, vendor):
         else:
             gw_ip = tmp_re.group(0).strip()
             break 
-    if gw_ip == '':
-        return l2_uplink
+    return gw_ip
 
-    # Get gateway MAC
-    cmd_get_gw_mac = re.sub('_IP_', gw_ip, cmd_get_gw_mac)
-    idx, cmd_out = uf_expect_sendline(ssh, timeout, f_out, sleep_time, cmd_get_gw_mac)
-    if idx == 1:
-        print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
-        return l2_uplink
-    if idx == -1:
-        return l2_uplink
+
+
+def uf_get_gw_mac(cmd_out):
+
+    gw_mac = ''
+    reg_get_gw_mac_search = '\s?([\da-f]{4}[\.-]){2}[\da-f]{4}\s?'
     tmp_row = ''
     tmp_out = cmd_out.split('\n')
     for tmp_row in tmp_out:
@@ -481,17 +1386,14 @@ def uf_get_l2_uplink(ssh, timeout, f_out, sleep_time, vendor):
         else:
             gw_mac = tmp_re.group(0).strip()
             break 
-    if gw_mac == '':
-        return l2_uplink
-   
-    # Get gateway uplink
-    cmd_get_gw_uplink = re.sub('_MAC_', gw_mac, cmd_get_gw_uplink)
-    idx, cmd_out = uf_expect_sendline(ssh, timeout, f_out, sleep_time, cmd_get_gw_uplink)
-    if idx == 1:
-        print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
-        return l2_uplink
-    if idx == -1:
-        return l2_uplink
+    return gw_mac
+
+
+
+def uf_get_gw_uplink(cmd_out, cmd_get_gw_uplink, gw_mac, vendor):
+
+    l2_uplink = ''
+    reg_get_gw_mac_search = '\s?([\da-f]{4}[\.-]){2}[\da-f]{4}\s?'
     tmp_row = ''
     tmp_out = cmd_out.split('\n')
     for tmp_row in tmp_out:
@@ -522,33 +1424,1064 @@ def uf_get_l2_uplink(ssh, timeout, f_out, sleep_time, vendor):
 
 
 
-def w_main(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeout, save, l2_sw):
+w_gw_mac = dict()                   # gateway IP -> MAC of the gateway, found once a run
+w_gw_mac_lock = threading.Lock()
+
+
+
+def uf_mac_format(gw_mac, vendor):
+
+    # 0cda.41b5.cf09 of Cisco, 0cda-41b5-cf09 of H3C and Huawei
+    gw_mac = re.sub('[^0-9a-f]', '', gw_mac.lower())
+    if len(gw_mac) != 12:
+        return ''
+    mac_sep = '.' if vendor in ['cisco', 'cisco_nexus'] else '-'
+    return mac_sep.join([gw_mac[0:4], gw_mac[4:8], gw_mac[8:12]])
+
+
+
+def uf_uplink_cache_get(ip, port, opt):
+
+    # [gw_ip, gw_mac, l2_uplink] of the device in --vendor_cache, or None
+    if opt.get('vendor_cache', '') == '':
+        return None
+    with w_vendor_cache_lock:
+        cache = w_vendor_cache.get('%s:%s' % (ip, port))
+        if cache is None or cache.get('l2_uplink', '') == '':
+            return None
+        return [cache['gw_ip'], cache['gw_mac'], cache['l2_uplink']]
+
+
+
+def uf_uplink_cache_set(ip, port, opt, gw_ip, gw_mac, l2_uplink):
+
+    # kept with vendor and model, and expires with them
+    if opt.get('vendor_cache', '') == '' or w_replay_dir != '':
+        return False
+    with w_vendor_cache_lock:
+        cache = w_vendor_cache.get('%s:%s' % (ip, port))
+        if cache is None:
+            return False
+        cache['gw_ip'] = gw_ip
+        cache['gw_mac'] = gw_mac
+        cache['l2_uplink'] = l2_uplink
+        cache['l2_time'] = int(time.time())     # time is of vendor and model, see uf_run_merge()
+    return True
+
+
+
+def uf_l2_uplink_step(ssh, timeout, f_out, sleep_time, cmd_line):
+
+    # output of a command of uf_get_l2_uplink(), or None
+    idx, cmd_out = yield from uf_expect_sendline(ssh, timeout, f_out, sleep_time, cmd_line)
+    if idx == 1:
+        print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ssh.w_ip, ssh.w_port))
+        return None
+    if idx == -1:
+        return None
+    return cmd_out
+
+
+
+def uf_get_l2_uplink(ssh, timeout, f_out, sleep_time, vendor, opt):
+    #
+    # The uplink is the port of the gateway MAC in the MAC table:
+    #
+    #   gateway IP (route) -> gateway MAC (ARP) -> port (MAC table)
+    #
+    # The uplink of the former run (--vendor_cache) is verified by the MAC
+    # table alone, and the MAC of a gateway IP, shared by all switches of a
+    # subnet, is asked by ARP once a run. So it's 1 or 2 commands instead of 3.
+    #
+    l2_uplink = ''
+    cmd_get_gw_ip, cmd_get_gw_mac, cmd_get_gw_uplink = uf_cmd_l2_uplink(vendor)
+
+    # The uplink of the former run
+    cache = uf_uplink_cache_get(ssh.w_ip, ssh.w_port, opt)
+    if cache is not None:
+        gw_ip, gw_mac, l2_uplink = cache
+        gw_mac = uf_mac_format(gw_mac, vendor)
+        cmd_line = re.sub('_MAC_', gw_mac, cmd_get_gw_uplink)
+        cmd_out = yield from uf_l2_uplink_step(ssh, timeout, f_out, sleep_time, cmd_line)
+        if cmd_out is None:
+            return ''
+        l2_uplink = uf_get_gw_uplink(cmd_out, cmd_line, gw_mac, vendor)
+        if l2_uplink != '':
+            uf_uplink_cache_set(ssh.w_ip, ssh.w_port, opt, gw_ip, gw_mac, l2_uplink)
+            return l2_uplink
+
+    # Get gateway IP
+    cmd_out = yield from uf_l2_uplink_step(ssh, timeout, f_out, sleep_time, cmd_get_gw_ip)
+    if cmd_out is None:
+        return l2_uplink
+    gw_ip = uf_get_gw_ip(cmd_out)
+    if gw_ip == '':
+        return l2_uplink
+
+    # Get gateway MAC, unless another switch got it. Not with --record or
+    # --replay, the commands of a recording must not depend on other hosts.
+    gw_mac = ''
+    if w_record_dir == '' and w_replay_dir == '':
+        with w_gw_mac_lock:
+            gw_mac = uf_mac_format(w_gw_mac.get(gw_ip, ''), vendor)
+    if gw_mac != '':
+        cmd_line = re.sub('_MAC_', gw_mac, cmd_get_gw_uplink)
+        cmd_out = yield from uf_l2_uplink_step(ssh, timeout, f_out, sleep_time, cmd_line)
+        if cmd_out is None:
+            return l2_uplink
+        l2_uplink = uf_get_gw_uplink(cmd_out, cmd_line, gw_mac, vendor)
+        if l2_uplink != '':
+            uf_uplink_cache_set(ssh.w_ip, ssh.w_port, opt, gw_ip, gw_mac, l2_uplink)
+            return l2_uplink
+    cmd_out = yield from uf_l2_uplink_step(ssh, timeout, f_out, sleep_time, re.sub('_IP_', gw_ip, cmd_get_gw_mac))
+    if cmd_out is None:
+        return l2_uplink
+    gw_mac_arp = uf_mac_format(uf_get_gw_mac(cmd_out), vendor)
+    if gw_mac_arp == '' or gw_mac_arp == gw_mac:
+        return l2_uplink
+    gw_mac = gw_mac_arp
+    with w_gw_mac_lock:
+        w_gw_mac[gw_ip] = gw_mac
+
+    # Get gateway uplink
+    cmd_line = re.sub('_MAC_', gw_mac, cmd_get_gw_uplink)
+    cmd_out = yield from uf_l2_uplink_step(ssh, timeout, f_out, sleep_time, cmd_line)
+    if cmd_out is None:
+        return l2_uplink
+    l2_uplink = uf_get_gw_uplink(cmd_out, cmd_line, gw_mac, vendor)
+    if l2_uplink != '':
+        uf_uplink_cache_set(ssh.w_ip, ssh.w_port, opt, gw_ip, gw_mac, l2_uplink)
+
+    return l2_uplink
+
+
+
+w_result_file = None               # --result, one JSON record per line
+w_result_lock = threading.Lock()
+
+
+
+def uf_result_write(record):
+
+    if w_result_file is None:
+        return
+    with w_result_lock:
+        w_result_file.write('%s\n' % (json.dumps(record, sort_keys=True)))
+
+
+
+def uf_result_init(ip, port):
+
+    # the host record, it's written by uf_result_end() when w_main() returns
+    return {'type': 'host', 'ip': ip, 'port': port, 'status': '', 'error': '', 'start': round(time.time(), 3), 'end': 0,
+            'vendor': '', 'model': '', 'l2_uplink': '', 'log': '', 'spans': list()}
+
+
+
+def uf_result_end(res, error):
+
+    # returns True if there's no error, as w_main() does
+    error = uf_replay_end(res, error)
+    res['status'] = 'ok' if error == '' else 'failed'
+    if uf_retry(error):
+        res['status'] = 'retry'
+    res['error'] = error
+    res['end'] = round(time.time(), 3)
+    uf_history_set(res)
+    uf_span_flush(res, res.pop('spans'))
+    uf_record_close(res)
+    # the log of a failed session is closed here, and an archived one is appended
+    f_log = res.pop('f_log', None)
+    if f_log is not None and not f_log.closed:
+        f_log.close()
+    if getattr(f_log, 'archive', None) is not None:
+        res['archive'] = f_log.archive
+    uf_result_write(res)
+    if res['status'] != 'retry':
+        uf_journal_write(res)
+    return error == ''
+
+
+
+def uf_prompt_error(cmd_out):
+
+    # no prompt after login: the password was asked again, or the device is just slow
+    if re.search('(P|p)assword: *$|denied|incorrect|Login failed', cmd_out.strip()) is not None:
+        return 'denied'
+    return 'prompt'
+
+
+
+def uf_result_mark(f_out):
+
+    # [start time, byte offset in the log] of a command, taken before it's sent
+    if isinstance(f_out, CmdLog):
+        f_out.cmd_start()
+    if w_result_file is None or f_out is None:
+        return [time.time(), None]
+    return [time.time(), f_out.tell()]
+
+
+
+def uf_result_cmd(res, f_out, num, cmd_line, idx, mark):
+    #
+    # One record per command, offset and length are of its output in the log
+    # file (echo and prompt included), so that it can be read by seek() alone.
+    #
+    if isinstance(f_out, CmdLog):
+        cmd_out = f_out.cmd_end()
+        uf_store_cmd(res, cmd_out, num, cmd_line, idx)
+        uf_parse_cmd(res, cmd_out, cmd_line, idx)
+    if w_result_file is None:
+        return
+    record = {'type': 'cmd', 'ip': res['ip'], 'port': res['port'], 'num': num, 'cmd': cmd_line,
+              'status': 'ok', 'error': '', 'start': round(mark[0], 3), 'end': round(time.time(), 3),
+              'log': res['log'], 'offset': mark[1], 'length': None}
+    if idx == 1:
+        record['status'] = 'failed'
+        record['error'] = 'timeout'
+    elif idx == 2:
+        record['status'] = 'failed'
+        record['error'] = 'cmd_error'
+    elif idx != 0:
+        record['status'] = 'failed'
+        record['error'] = 'failed'
+    if mark[1] is not None:
+        record['length'] = f_out.tell() - mark[1]
+    uf_result_write(record)
+
+
+
+w_archive_dir = ''                  # --archive, gzip segments instead of a log file per host
+w_archive_size = 1 << 30            # a segment is closed at 1 GiB, and a new one is started
+w_archive_seg = [None, None, '', 0] # [segment file, index file, segment name, count of segments]
+w_archive_lock = threading.Lock()
+
+
+
+class ArchiveLog(object):
+    #
+    # f_out of a session with --archive: the output is gzip-compressed as it's
+    # written and spooled to an unlinked temp file in <dir>, not held in memory
+    # (a show tech-support of 1000 sessions would be), and close() appends it to
+    # the current segment as one gzip member. tell() is the offset in the
+    # transcript, as it would be in a log file of --log_dir, for --result.
+    #
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.closed = False
+        self.size = 0
+        self.data = tempfile.TemporaryFile(dir=w_archive_dir)
+        self.comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.archive = None             # [segment, offset, length] once appended
+
+    def write(self, str_out):
+        data = str_out.encode('utf-8', 'replace')
+        self.size += len(data)
+        self.data.write(self.comp.compress(data))
+        return len(str_out)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.data.write(self.comp.flush())
+            self.data.flush()
+            self.archive = uf_archive_append(self.ip, self.port, self.data, self.size)
+        finally:
+            self.data.close()
+            self.data = None
+
+
+
+def uf_archive_append(ip, port, f_data, size):
+    #
+    # Segments are <dir>/<time>.<pid>.<num>.gz, a concatenation of gzip members
+    # which zcat reads as a whole, and <segment>.idx has one JSON line per host:
+    #
+    #   {"ip": ..., "port": ..., "offset": ..., "length": ..., "size": ..., "time": ...}
+    #
+    # A host is read alone by: tail -c +<offset + 1> <segment> | head -c <length> | zcat
+    #
+    # f_data is the spool of ArchiveLog, copied in chunks of 1 MiB.
+    #
+    length = f_data.tell()
+    with w_archive_lock:
+        try:
+            if w_archive_seg[0] is None or w_archive_seg[0].tell() + length > w_archive_size and w_archive_seg[0].tell() > 0:
+                uf_archive_close()
+                w_archive_seg[3] += 1
+                w_archive_seg[2] = '%s/%s.%s.%03d.gz' % (w_archive_dir, w_time('%Y%m%d%H%M%S'), os.getpid(), w_archive_seg[3])
+                w_archive_seg[0] = open(w_archive_seg[2], 'ab')
+                w_archive_seg[1] = open('%s.idx' % (w_archive_seg[2]), 'a')
+            offset = w_archive_seg[0].tell()
+            f_data.seek(0)
+            while True:
+                data = f_data.read(1 << 20)
+                if not data:
+                    break
+                w_archive_seg[0].write(data)
+            w_archive_seg[0].flush()
+            w_archive_seg[1].write('%s\n' % (json.dumps({'ip': ip, 'port': port, 'offset': offset, 'length': length,
+                                   'size': size, 'time': round(time.time(), 3)}, sort_keys=True)))
+            w_archive_seg[1].flush()
+            return [w_archive_seg[2], offset, length]
+        except OSError as e:
+            print('[%s] %s:%s Error: archive %s is failed to write, %s.' % (w_time(), ip, port, w_archive_seg[2], e))
+            return None
+
+
+
+w_store_dir = ''                    # --store, output of each command by its sha256
+w_store_file = None                 # manifest of the run in --store
+w_store_lock = threading.Lock()
+
+
+
+class CmdLog(object):
+    #
+    # f_out of a session with --store or --parse: what's written goes on to
+    # the log of --log_dir or --archive (stdout if none), and the output of
+    # each command, from uf_result_mark() to uf_result_cmd(), is cut out: it's
+    # hashed and gzip-compressed as it goes for uf_store_blob(), and kept as
+    # text for the parsers of uf_parse_cmd().
+    #
+    def __init__(self, f_log):
+        self.f_log = f_log
+        self.closed = False
+        self.size = 0
+        self.cmd = None                 # [sha256, compressor, compressed data, size, text]
+        self.archive = None
+
+    def write(self, str_out):
+        if self.f_log is None:
+            sys.stdout.write(str_out)
+        else:
+            self.f_log.write(str_out)
+        data = str_out.encode('utf-8', 'replace')
+        self.size += len(data)
+        if self.cmd is not None:
+            self.cmd[3] += len(data)
+            if w_store_dir != '':
+                self.cmd[0].update(data)
+                self.cmd[2].write(self.cmd[1].compress(data))
+            if w_parse_list is not None:
+                self.cmd[4].append(str_out)
+        return len(str_out)
+
+    def tell(self):
+        if self.f_log is None:
+            return self.size
+        return self.f_log.tell()
+
+    def flush(self):
+        if self.f_log is not None:
+            self.f_log.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.f_log is not None:
+            self.f_log.close()
+            self.archive = getattr(self.f_log, 'archive', None)
+
+    def cmd_start(self):
+        self.cmd = [hashlib.sha256(), zlib.compressobj(6, zlib.DEFLATED, 31), io.BytesIO(), 0, list()]
+
+    def cmd_end(self):
+        # {size, text, and sha256, new or not with --store} of the output since cmd_start()
+        if self.cmd is None:
+            return None
+        sha256, comp, data, size, text = self.cmd
+        self.cmd = None
+        cmd_out = {'size': size, 'text': ''.join(text)}
+        if w_store_dir != '':
+            data.write(comp.flush())
+            cmd_out['sha256'] = sha256.hexdigest()
+            cmd_out['new'] = uf_store_blob(cmd_out['sha256'], data.getvalue())
+        return cmd_out
+
+
+
+def uf_store_blob(sha256, data):
+    #
+    # --store: <dir>/objects/<2 hex>/<62 hex>.gz, written once, by a temporary
+    # file and rename so that a reader never sees half a blob. Returns True if
+    # the blob is new.
+    #
+    blob_file = '%s/objects/%s/%s.gz' % (w_store_dir, sha256[:2], sha256[2:])
+    if os.path.exists(blob_file):
+        return False
+    try:
+        os.makedirs(os.path.dirname(blob_file), exist_ok=True)
+        tmp_file = '%s.%s.%s.tmp' % (blob_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'wb') as f_blob:
+            f_blob.write(data)
+        os.replace(tmp_file, blob_file)
+    except OSError as e:
+        print('[%s] Error: %s is failed to write, %s.' % (w_time(), blob_file, e))
+        return False
+    return True
+
+
+
+def uf_store_cmd(res, cmd_out, num, cmd_line, idx):
+
+    # one line of the manifest per command, a changed output is a changed sha256
+    if w_store_file is None or cmd_out is None:
+        return
+    record = {'ip': res['ip'], 'port': res['port'], 'num': num, 'cmd': cmd_line, 'status': 'ok' if idx == 0 else 'failed',
+              'sha256': cmd_out['sha256'], 'size': cmd_out['size'], 'new': cmd_out['new'], 'time': round(time.time(), 3)}
+    with w_store_lock:
+        w_store_file.write('%s\n' % (json.dumps(record, sort_keys=True)))
+        w_store_file.flush()
+
+
+
+w_parse_list = None                 # --parse, [vendor, regex of command, table, function] of the parser file
+w_parse_proc = 1                    # processes of the parser pool
+w_parse_pool = None
+w_parse_room = None                 # semaphore of the outputs queued to the pool, 16 for each process
+w_parse_dir = ''                    # --parse_dir
+w_parse_format = 'jsonl'            # --parse_format
+w_parse_files = dict()              # (vendor, table) -> [file, fields of csv]
+w_parse_lock = threading.Lock()
+
+
+
+def uf_parse_load(parse_file):
+    #
+    # --parse: a Python file with a list of parsers, see example_-_show_users/:
+    #
+    #   w_parser = [[vendor or '*', regex of command, table, function], ...]
+    #
+    # function(output) returns rows (a list of dict) of the table, output is
+    # what the command printed, from its echo to the prompt after it.
+    #
+    try:
+        parse_env = runpy.run_path(parse_file)
+        parse_list = list()
+        for vendor, cmd_re, table, parse_func in parse_env['w_parser']:
+            parse_list.append([vendor, re.compile(cmd_re, re.IGNORECASE), table, parse_func])
+    except Exception as e:
+        print('%s is wrong, please check --parse: %s\n' % (parse_file, e))
+        return None
+    return parse_list
+
+
+
+def uf_parse_run(parse_idx, cmd_text):
+
+    # in a process of the pool, which has w_parse_list as its parent by fork
+    try:
+        return [w_parse_list[parse_idx][3](cmd_text), '']
+    except Exception as e:
+        return [None, '%s: %s' % (type(e).__name__, e)]
+
+
+
+def uf_parse_wait():
+    #
+    # The outputs queued to the pool are bounded by w_parse_room, or they'd
+    # pile up in memory while the parsers are slower than the sessions. A
+    # session waits here before its next command, as a step of its flow,
+    # rather than in uf_parse_cmd() where asyncio would wait with it.
+    #
+    if w_parse_room is None:
+        return
+    while not w_parse_room.acquire(blocking=False):
+        yield from uf_io(None, 'sleep', 0.05)
+    w_parse_room.release()
+
+
+
+def uf_parse_cmd(res, cmd_out, cmd_line, idx):
+
+    # the output goes to the parsers of its vendor and command as soon as it's done
+    if w_parse_pool is None or cmd_out is None or idx != 0:
+        return
+    for parse_idx in range(0, len(w_parse_list)):
+        vendor, cmd_re, table, parse_func = w_parse_list[parse_idx]
+        if vendor not in ['*', res['vendor']] or cmd_re.search(cmd_line) is None:
+            continue
+        row_key = {'ip': res['ip'], 'port': res['port'], 'vendor': res['vendor'], 'cmd': cmd_line}
+        w_parse_room.acquire()
+        w_parse_pool.apply_async(uf_parse_run, (parse_idx, cmd_out['text']),
+                                 callback=lambda parse_out, row_key=row_key, table=table: uf_parse_done(row_key, table, parse_out),
+                                 error_callback=lambda e, row_key=row_key, table=table: uf_parse_done(row_key, table, [None, '%s: %s' % (type(e).__name__, e)]))
+
+
+
+def uf_parse_done(row_key, table, parse_out):
+
+    # in the result thread of the pool, which stops for good if a callback raises
+    try:
+        uf_parse_write(row_key, table, parse_out)
+    except Exception as e:
+        print('[%s] %s:%s Error: parse output of %s is failed to write, %s: %s.' % (w_time(), row_key['ip'], row_key['port'], table, type(e).__name__, e))
+    finally:
+        w_parse_room.release()
+
+
+
+def uf_parse_write(row_key, table, parse_out):
+    #
+    # Rows of an output are appended as one batch to <parse_dir>/<vendor>.<table>.<format>,
+    # under flock as the processes of --workers write the same files. The fields
+    # of a csv are its header, or the ones of its first row.
+    #
+    rows, error = parse_out
+    if rows is None:
+        print('[%s] %s:%s Error: parser of %s failed, %s.' % (w_time(), row_key['ip'], row_key['port'], table, error))
+        return
+    if len(rows) == 0:
+        return
+    file_key = (row_key['vendor'], table)
+    with w_parse_lock:
+        try:
+            if file_key not in w_parse_files:
+                w_parse_files[file_key] = [open('%s/%s.%s.%s' % (w_parse_dir, row_key['vendor'], table, w_parse_format), 'a+', newline=''), None]
+            f_parse, fields = w_parse_files[file_key]
+            fcntl.flock(f_parse, fcntl.LOCK_EX)
+            try:
+                batch = io.StringIO()
+                if w_parse_format == 'csv':
+                    f_parse.seek(0, os.SEEK_END)
+                    if fields is None and f_parse.tell() > 0:
+                        f_parse.seek(0)
+                        fields = next(csv.reader([f_parse.readline()]))
+                    if fields is None:
+                        fields = list(row_key) + [k for k in rows[0] if k not in row_key]
+                        csv.writer(batch).writerow(fields)
+                    w_parse_files[file_key][1] = fields
+                    csv_writer = csv.DictWriter(batch, fields, extrasaction='ignore')
+                    for row in rows:
+                        record = dict(row_key)
+                        record.update(row)
+                        csv_writer.writerow(record)
+                else:
+                    for row in rows:
+                        record = dict(row_key)
+                        record.update(row)
+                        batch.write('%s\n' % (json.dumps(record, sort_keys=True)))
+                f_parse.write(batch.getvalue())
+                f_parse.flush()
+            finally:
+                fcntl.flock(f_parse, fcntl.LOCK_UN)
+        except (OSError, csv.Error) as e:
+            print('[%s] %s:%s Error: parse output of %s is failed to write, %s.' % (w_time(), row_key['ip'], row_key['port'], table, e))
+
+
+
+def uf_parse_end():
+
+    # the outputs queued are parsed before the run ends
+    global w_parse_pool, w_parse_room
+    if w_parse_pool is None:
+        return
+    w_parse_pool.close()
+    w_parse_pool.join()
+    w_parse_pool = None
+    w_parse_room = None
+    for file_key in w_parse_files:
+        w_parse_files[file_key][0].close()
+    w_parse_files.clear()
+
+
+
+def uf_archive_close():
+
+    # called with w_archive_lock held, or at the end of the run
+    if w_archive_seg[0] is not None:
+        w_archive_seg[0].close()
+        w_archive_seg[1].close()
+        w_archive_seg[0] = None
+        w_archive_seg[1] = None
+
+
+
+#
+# Errors of a session (error of --result):
+#
+#   args            wrong arguments of w_main()
+#   unreachable     TCP connect of --precheck failed, ssh was not spawned
+#   ssh             ssh failed to start
+#   login_timeout   no password prompt
+#   login_eof       ssh exited before the password prompt, e.g. connection refused
+#   known_hosts     host key changed, it's fixed by uf_login_fix_known_hosts()
+#   host_key        host key changed, and failed to fix
+#   denied          password was asked again
+#   prompt          no prompt after login
+#   timeout         a command timed out
+#   cmd_error       output of a command matched its error=, see uf_cmd_plan()
+#   vendor, model   failed to get vendor or model
+#   cmd_prefix      no command file of the vendor
+#   save_timeout    save config timed out
+#   exception       an unexpected exception of the session flow, see w_session()
+#   replay          a send of --replay differs from the recording, see uf_replay_diverged()
+#
+# Transient ones are retried at the end of the run with --retry, known_hosts is
+# retried once anyway. save_timeout is not, as the config may have been changed.
+#
+w_retry_error = ['ssh', 'login_timeout', 'login_eof', 'prompt', 'timeout']
+w_retry_max = 0                     # --retry
+w_retry_wait = 30                   # --retry_wait
+w_journal_file = None               # --journal, ip:port of the hosts done
+w_journal_lock = threading.Lock()
+
+
+
+def uf_retry(error):
+
+    if error == 'known_hosts':
+        return w_requeue(max(1, w_retry_max))
+    if error in w_retry_error:
+        return w_requeue(w_retry_max, w_retry_wait)
+    return False
+
+
+
+def uf_journal_load(file_name):
+
+    # ip:port of the hosts done well, which are skipped by --resume
+    host_done = set()
+    try:
+        f_journal = open(file_name)
+        for line in f_journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue                # the last line of a killed run
+            if record.get('status') == 'ok':
+                host_done.add('%s:%s' % (record['ip'], record['port']))
+        f_journal.close()
+    except OSError:
+        pass
+    return host_done
+
+
+
+def uf_journal_write(res):
+
+    # appended and flushed as each host is done, so a killed run could be resumed
+    if w_journal_file is None:
+        return
+    with w_journal_lock:
+        w_journal_file.write('%s\n' % (json.dumps({'ip': res['ip'], 'port': res['port'], 'status': res['status'],
+                             'error': res['error'], 'time': res['end']}, sort_keys=True)))
+        w_journal_file.flush()
+
+
+
+w_history = None                    # --history, ip:port -> {duration, vendor, model, time}
+w_history_lock = threading.Lock()
+
+
+
+def uf_history_load(file_name):
+
+    global w_history
+    w_history = dict()
+    if not os.path.exists(file_name):
+        return w_history
+    try:
+        f_history = open(file_name)
+        w_history = json.load(f_history)
+        f_history.close()
+    except:
+        print('[%s] Warning: %s is not a history file, ignored.' % (w_time(), file_name))
+        w_history = dict()
+    return w_history
+
+
+
+def uf_history_save(file_name):
+
+    with w_history_lock:
+        try:
+            f_history = open('%s.tmp' % (file_name), 'w')
+            json.dump(w_history, f_history, indent=1, sort_keys=True)
+            f_history.close()
+            os.replace('%s.tmp' % (file_name), file_name)
+        except:
+            print('[%s] Error: history %s is failed to save.' % (w_time(), file_name))
+            return False
+    return True
+
+
+
+def uf_history_set(res):
+
+    # duration of a session, averaged with the former ones (half and half)
+    if w_history is None or res['status'] == 'retry' or res['error'] in ['args', 'unreachable']:
+        return
+    host_key = '%s:%s' % (res['ip'], res['port'] or '22')
+    duration = res['end'] - res['start']
+    with w_history_lock:
+        host = w_history.get(host_key, dict())
+        if 'duration' in host:
+            duration = (host['duration'] + duration) / 2
+        w_history[host_key] = {'duration': round(duration, 3), 'vendor': res['vendor'] or host.get('vendor', ''),
+                               'model': res['model'] or host.get('model', ''), 'time': int(time.time())}
+
+
+
+def uf_history_sort(func_args):
+    #
+    # --history: longest expected job first, so that the slowest hosts don't
+    # start at the end and stretch the run. A host not in the history is
+    # expected as the average of its vendor and model, or of its vendor
+    # (--host_file, --vendor_cache), or of all hosts. Hosts expected the same
+    # keep their order.
+    #
+    arg_list = list(func_args)
+    duration_sum = dict()
+    with w_history_lock:
+        for host in w_history.values():
+            for avg_key in [(host['vendor'], host['model']), (host['vendor'], ''), ('', '')]:
+                duration_sum.setdefault(avg_key, [0, 0])
+                duration_sum[avg_key][0] += host['duration']
+                duration_sum[avg_key][1] += 1
+
+    def uf_expect(args):
+        host_key = '%s:%s' % (args[0], args[1] or '22')
+        if host_key in w_history:
+            return w_history[host_key]['duration']
+        vendor = (args[12] or dict()).get('vendor', '')
+        model = ''
+        with w_vendor_cache_lock:
+            cache = w_vendor_cache.get(host_key)
+        if cache is not None and vendor in ['', cache['vendor']]:
+            vendor = cache['vendor']
+            model = cache['model']
+        for avg_key in [(vendor, model), (vendor, ''), ('', '')]:
+            if avg_key in duration_sum:
+                return duration_sum[avg_key][0] / duration_sum[avg_key][1]
+        return 0
+
+    arg_list.sort(key=uf_expect, reverse=True)
+    if len(arg_list) > 0 and len(duration_sum) > 0:
+        print('[%s] %s hosts are ordered by --history, the longest is expected in %.1fs.' % (w_time(), len(arg_list), uf_expect(arg_list[0])))
+    return arg_list
+
+
+
+w_record_dir = ''                   # --record, the byte stream of each session with timing
+w_replay_dir = ''                   # --replay, sessions are fed from the recordings of --record
+w_replay_speed = 1.0                # --replay_speed, 0 is as fast as possible
+
+
+
+class RecordLog(object):
+    #
+    # logfile_read / logfile_send of a spawn with --record, one JSON line for
+    # each read or send:  [seconds since spawn, 'r' | 's', text]
+    # The password is never written, a send of it is recorded as '********'.
+    #
+    def __init__(self, f_rec, start_time, tag, pwd):
+        self.f_rec = f_rec
+        self.start_time = start_time
+        self.tag = tag
+        self.pwd = pwd
+
+    def write(self, s):
+        if self.f_rec.closed:
+            return len(s)
+        text = s
+        if self.tag == 's' and self.pwd != '' and s.rstrip('\r\n') == self.pwd:
+            text = '********%s' % (s[len(self.pwd):])
+        self.f_rec.write('%s\n' % (json.dumps([round(time.time() - self.start_time, 6), self.tag, text])))
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+
+def uf_record_open(ssh, ip, port, pwd, ssh_cmd, res):
+    #
+    # --record: a session goes to <dir>/<ip>_<port>.jsonl, the first line is
+    # {"ip", "port", "time", "ssh_cmd"}, then the lines of RecordLog, and
+    # [seconds, 'e', ''] if the device closed the session. A retried host is
+    # recorded again, the last attempt is kept.
+    #
+    if w_record_dir == '':
+        return
+    record_file = '%s/%s_%s.jsonl' % (w_record_dir, ip, port)
+    try:
+        f_rec = open(record_file, 'w')
+    except OSError:
+        print('[%s] %s:%s Warning: %s is failed to open, the session is not recorded.' % (w_time(), ip, port, record_file))
+        return
+    start_time = time.time()
+    f_rec.write('%s\n' % (json.dumps({'ip': ip, 'port': port, 'time': round(start_time, 3), 'ssh_cmd': ssh_cmd})))
+    ssh.logfile_read = RecordLog(f_rec, start_time, 'r', pwd)
+    ssh.logfile_send = RecordLog(f_rec, start_time, 's', pwd)
+    res['f_record'] = [f_rec, start_time, ssh]
+
+
+
+def uf_record_close(res):
+
+    rec = res.pop('f_record', None)
+    if rec is None:
+        return
+    f_rec, start_time, ssh = rec
+    if ssh.flag_eof:
+        f_rec.write('%s\n' % (json.dumps([round(time.time() - start_time, 6), 'e', ''])))
+    f_rec.close()
+
+
+
+def uf_replay_load(ip, port):
+    #
+    # A recording of --record as [event_list, send_list]. An event is
+    # [gate, delay, tag, text]: the device holds a read back until we have made
+    # <gate> sends, as it did when it was recorded, and sends it <delay>
+    # seconds after the event before it, a read or one of our sends. send_list
+    # is the text of our sends, each send of the replay is checked against it.
+    #
+    record_file = '%s/%s_%s.jsonl' % (w_replay_dir, ip, port)
+    try:
+        with open(record_file) as f_rec:
+            f_rec.readline()
+            event_list = list()
+            send_list = list()
+            last_time = 0
+            for line in f_rec:
+                event_time, tag, text = json.loads(line)
+                if tag == 's':
+                    send_list.append(text)
+                else:
+                    event_list.append([len(send_list), event_time - last_time, tag, text])
+                last_time = event_time
+    except (OSError, ValueError):
+        print('[%s] %s:%s Error: %s is not a recording of --record.' % (w_time(), ip, port, record_file))
+        raise
+    return [event_list, send_list]
+
+
+
+def uf_replay_diverged(send_list, num, s):
+    #
+    # '' if the num-th send (from 0) is the one of the recording, or why not.
+    # The replay took another path than the recorded session, e.g. a different
+    # option or cache, so the recorded output would answer the wrong command.
+    #
+    if num >= len(send_list):
+        return 'send %s %r is beyond the recording' % (num + 1, s)
+    text = send_list[num]
+    if text == s or text.startswith('********') and s.endswith(text[8:]):
+        return ''                       # the password is masked in the recording
+    return 'send %s is %r, it was %r in the recording' % (num + 1, s, text)
+
+
+
+def uf_replay_end(res, error):
+
+    # the error of a session of --replay which went off its recording
+    ssh = res.pop('replay', None)
+    if ssh is None or ssh.w_diverged == '':
+        return error
+    print('[%s] %s:%s Error: replay diverged, %s.' % (w_time(), ssh.w_ip, ssh.w_port, ssh.w_diverged))
+    return 'replay'
+
+
+
+def uf_replay_delay(delay):
+
+    if w_replay_speed <= 0:
+        return 0
+    return delay / w_replay_speed
+
+
+
+class ReplaySpawn(SpawnBase):
+    #
+    # --replay of the thread engine, in place of pexpect.spawn: read_nonblocking()
+    # returns the reads of the recording in order, each one when the device
+    # would have sent it. Everything due so far is returned at once, as a read
+    # of the pty does. Once a send differs from the recording, the device
+    # hangs up: reads get EOF, and the session ends with error replay.
+    #
+    def __init__(self, ip, port, timeout=30, maxread=2000, searchwindowsize=None):
+        SpawnBase.__init__(self, timeout, maxread, searchwindowsize, encoding='utf-8', codec_errors='replace')
+        self.w_event_list, self.w_send_list = uf_replay_load(ip, port)
+        self.w_pos = 0
+        self.w_sends = 0
+        self.w_mark = time.time()       # when the event before the next one was seen
+        self.w_diverged = ''            # see uf_replay_diverged()
+        self.closed = False
+        self.name = '<replay %s:%s>' % (ip, port)
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        if self.w_diverged != '':
+            self.flag_eof = True
+            raise pexpect.EOF('End Of File (EOF), the replay diverged.')
+        if timeout == -1 or timeout is None:
+            timeout = self.timeout
+        end_time = time.time() + timeout
+        data = ''
+        while self.w_pos < len(self.w_event_list):
+            gate, delay, tag, text = self.w_event_list[self.w_pos]
+            due = None if gate > self.w_sends else self.w_mark + uf_replay_delay(delay)
+            if data != '' and (due is None or due > time.time() or tag == 'e'):
+                break
+            if due is None or due > end_time:
+                time.sleep(max(end_time - time.time(), 0))
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            if due > time.time():
+                time.sleep(due - time.time())
+            self.w_pos += 1
+            self.w_mark = due
+            if tag == 'e':
+                self.flag_eof = True
+                raise pexpect.EOF('End Of File (EOF).')
+            data += text
+        if data == '':
+            # the recording ends here, the device is silent from now on
+            time.sleep(max(end_time - time.time(), 0))
+            raise pexpect.TIMEOUT('Timeout exceeded.')
+        self._log(data, 'read')
+        return data
+
+    def send(self, s):
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        if self.w_diverged == '':
+            self.w_diverged = uf_replay_diverged(self.w_send_list, self.w_sends, s)
+        if self.w_pos < len(self.w_event_list) and self.w_event_list[self.w_pos][0] > self.w_sends:
+            self.w_mark = time.time()   # the next read waits for this send
+        self.w_sends += 1
+        return len(s)
+
+    def sendline(self, s=''):
+        return self.send(s + self.linesep)
+
+    def isalive(self):
+        return not self.closed and not self.flag_eof
+
+    def close(self, force=True):
+        self.closed = True
+
+
+
+w_span_on = False                   # --timing or --trace
+w_span_lock = threading.Lock()
+w_span_time = dict()                # (phase, vendor) -> list of seconds
+w_trace_file = None                 # --trace, Chrome trace event format
+w_trace_count = 0
+w_trace_pid = 1                     # one row group of the trace viewer for each process of --workers
+
+
+
+def uf_span(res, phase, detail=''):
+    #
+    # A phase of the session starts, and the former one ends, e.g.
+    #
+    #   admit, spawn, login, prompt, vendor, nomore, l2_uplink, command, ..., save, logout
+    #
+    # The last one ends with uf_result_end().
+    #
+    if not w_span_on:
+        return
+    span_time = time.time()
+    if len(res['spans']) > 0 and res['spans'][-1][2] is None:
+        res['spans'][-1][2] = span_time
+    res['spans'].append([phase, span_time, None, detail])
+
+
+
+def uf_span_flush(res, spans):
+
+    global w_trace_count
+    if not w_span_on or len(spans) == 0:
+        return
+    if spans[-1][2] is None:
+        spans[-1][2] = time.time()
+    vendor = res['vendor'] if res['vendor'] != '' else '-'
+    with w_span_lock:
+        for phase, span_start, span_end, detail in spans:
+            w_span_time.setdefault((phase, vendor), list()).append(span_end - span_start)
+        if w_trace_file is None:
+            return
+        # one row of the trace viewer for each session
+        w_trace_count += 1
+        trace_event = {'name': 'thread_name', 'ph': 'M', 'pid': w_trace_pid, 'tid': w_trace_count, 'args': {'name': '%s:%s' % (res['ip'], res['port'])}}
+        w_trace_file.write(',\n%s' % (json.dumps(trace_event)))
+        for phase, span_start, span_end, detail in spans:
+            trace_event = {'name': phase, 'cat': vendor, 'ph': 'X', 'pid': w_trace_pid, 'tid': w_trace_count,
+                           'ts': int(span_start * 1000000), 'dur': int((span_end - span_start) * 1000000),
+                           'args': {'ip': res['ip'], 'vendor': vendor, 'error': res['error']}}
+            if detail != '':
+                trace_event['args']['cmd'] = detail
+            w_trace_file.write(',\n%s' % (json.dumps(trace_event)))
+
+
+
+def uf_span_summary():
+
+    # p50/p95/p99 of each phase, of all vendors (*) and of each vendor
+    span_time = dict()
+    for phase, vendor in w_span_time:
+        span_time.setdefault((phase, '*'), list()).extend(w_span_time[(phase, vendor)])
+        span_time[(phase, vendor)] = w_span_time[(phase, vendor)]
+    phase_list = ['admit', 'spawn', 'login', 'prompt', 'vendor', 'nomore', 'l2_uplink', 'command', 'save', 'logout']
+    print('\n%s%s%s%s%s%s%s' % ('Phase'.ljust(12), 'Vendor'.ljust(14), 'Count'.rjust(8), 'p50'.rjust(10), 'p95'.rjust(10), 'p99'.rjust(10), 'Max'.rjust(10)))
+    for phase, vendor in sorted(span_time, key=lambda k: (phase_list.index(k[0]), k[1] != '*', k[1])):
+        time_list = sorted(span_time[(phase, vendor)])
+        time_pct = [time_list[min(len(time_list) - 1, int(len(time_list) * pct))] for pct in (0.50, 0.95, 0.99)]
+        print('%s%s%s%s%s%s%s' % (phase.ljust(12), vendor.ljust(14), str(len(time_list)).rjust(8),
+              ('%.3f' % time_pct[0]).rjust(10), ('%.3f' % time_pct[1]).rjust(10), ('%.3f' % time_pct[2]).rjust(10),
+              ('%.3f' % time_list[-1]).rjust(10)))
+
+
+
+def uf_init_args(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeout, save, l2_sw):
+    #
+    # Shared by w_main() and w_main_async(), returns None if any argument is wrong,
+    # otherwise [port, cmd_plan, sleep_time, output_file, f_out, timeout, save, l2_sw]
+    #
     #_________ start of arguments init _________
     # arg: ip
     if not isinstance(ip, str) or ip.strip() == '':
         print('[%s] Error: incorrect IP address <%s>' % (w_time(), ip))
-        return False
+        return None
     # arg: port
     if not isinstance(port, str) or port.strip() == '':
         port = '22'
     # arg: uid
     if not isinstance(uid, str) or uid.strip() == '':
         print('[%s] %s:%s Error: incorrect UID' % (w_time(), ip, port))
-        return False
+        return None
     # arg: pwd
     if not isinstance(pwd, str) or pwd.strip() == '':
         print('[%s] %s:%s Error: incorrect PWD' % (w_time(), ip, port))
-        return False
+        return None
     # arg: cmd, cmd_prefix
-    cmd_list = list()
+    cmd_plan = tuple()
     if not isinstance(cmd, str) or cmd is None or cmd.strip() == '':
         if not isinstance(cmd_prefix, str) or cmd_prefix is None or cmd_prefix.strip() == '':
             print('[%s] %s:%s Warning: neither --cmd nor --cmd_prefix was specified.\n' % (w_time(), ip, port))
         else:
-            cmd_list = None
+            cmd_plan = None
             # Then go to place where vendor was alreay identified.
     else:
-        cmd_list = cmd.split(';')
+        with w_cmd_plan_lock:
+            if ('--cmd', cmd) not in w_cmd_plan:
+                w_cmd_plan[('--cmd', cmd)] = uf_cmd_plan(cmd.split(';'), '--cmd')
+            cmd_plan = w_cmd_plan[('--cmd', cmd)]
+        if cmd_plan is None:
+            return None
     # arg: cmd_interval, default 0.5
     if isinstance(cmd_interval, float):
         sleep_time = cmd_interval
@@ -560,6 +2493,12 @@ def w_main(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeo
     f_out = None
     if not isinstance(log_dir, str) or log_dir is None or log_dir.strip() == '':
         output_file = ''
+        if w_archive_dir != '':
+            try:
+                f_out = ArchiveLog(ip, port)
+            except OSError as e:
+                print('[%s] %s:%s Error: archive %s is failed to open, %s.' % (w_time(), ip, port, w_archive_dir, e))
+                return None
     else:
         output_file = '%s/%s' % (log_dir, ip)
         output_path = os.path.dirname(output_file)
@@ -568,17 +2507,19 @@ def w_main(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeo
                 sys_cmd('mkdir -p %s' % (output_path))
             except:
                 print('[%s] %s:%s Error: mkdir %s failed!' % (w_time(), ip, port, output_path))
-                return False
+                return None
         if os.path.exists(output_path):
             try:
                 f_out = open(output_file, 'w')
             except:
                 print('[%s] %s:%s Error: file %s is failed to open.' % (w_time(), ip, port, output_file))
-                return False
+                return None
         else:
             output_file = ''
-    if output_file == '':
+    if output_file == '' and w_archive_dir == '':
         f_out = None
+    if w_store_dir != '' or w_parse_list is not None:
+        f_out = CmdLog(f_out)
     # arg: timeout
     if isinstance(flt_timeout, float):
         timeout = flt_timeout
@@ -591,104 +2532,1012 @@ def w_main(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeo
     if not isinstance(l2_sw, str) or l2_sw.strip() == '':
         l2_sw = 'no'
     #_________ end of arguments init _________
+    return [port, cmd_plan, sleep_time, output_file, f_out, timeout, save, l2_sw]
 
-    # Login - ssh
-    try:
-        print('[%s] ssh -p %s -l %s %s' % (w_time(), port, uid, ip))
-        ssh = pexpect.spawn('ssh -p %s -l %s %s' % (port, uid, ip))
-        time.sleep(sleep_time)
-    except:
-        print('[%s] %s:%s Error: ssh failed' % (w_time(), ip, port))
-        return False
-    if not uf_ssh_login(ssh, timeout, output_file, f_out, ip, port, uid, pwd, sleep_time):
+
+
+w_cmd_plan = dict()                 # --cmd or command file -> cmd_plan, shared by all sessions
+w_cmd_plan_lock = threading.Lock()
+
+
+
+def uf_cmd_plan(cmd_list, cmd_source):
+    #
+    # A command could be followed by options of its own:
+    #
+    #   display current-configuration       #@ timeout=300
+    #   reset counters interface            #@ prompt='\[Y/N\]:'
+    #   undo shutdown                       #@ error='^(Error|% )'
+    #
+    #   timeout     seconds to wait for the prompt, instead of --timeout
+    #   prompt      regex of what the command ends with, instead of the prompt
+    #   error       regex of a failed output, the session stops there
+    #
+    # Returns a tuple of (cmd_line, timeout, prompt, error) of each command,
+    # None for an option not given, or returns None if any option is wrong.
+    #
+    cmd_plan = list()
+    for cmd_line in cmd_list:
+        cmd_step = [cmd_line.strip(), None, None, None]
+        tmp_re = re.search('^(.*?)\\s*#@(.*)$', cmd_step[0])
+        if tmp_re is not None:
+            cmd_step[0] = tmp_re.group(1)
+            try:
+                for cmd_opt in shlex.split(tmp_re.group(2)):
+                    opt_key, opt_value = cmd_opt.split('=', 1)
+                    if opt_key == 'timeout':
+                        cmd_step[1] = float(opt_value)
+                    elif opt_key == 'prompt':
+                        cmd_step[2] = re.compile(opt_value, re.MULTILINE)
+                    elif opt_key == 'error':
+                        cmd_step[3] = re.compile(opt_value, re.MULTILINE)
+                    else:
+                        raise ValueError('unknown option %s' % (opt_key))
+            except (ValueError, re.error) as e:
+                print('[%s] Error: wrong "#@%s" of %s, %s' % (w_time(), tmp_re.group(2), cmd_source, e))
+                return None
+        cmd_plan.append(tuple(cmd_step))
+    return tuple(cmd_plan)
+
+
+
+def uf_get_cmd_plan(cmd_prefix, vendor, ip, port):
+
+    # the command file of a vendor is read and parsed once a run
+    cmd_file = '%s.cmd.%s' % (cmd_prefix, vendor)
+    with w_cmd_plan_lock:
+        if cmd_file not in w_cmd_plan:
+            w_cmd_plan[cmd_file] = None
+            if os.path.exists(cmd_file):
+                f_cmd = open(cmd_file)
+                w_cmd_plan[cmd_file] = uf_cmd_plan(f_cmd.readlines(), cmd_file)
+                f_cmd.close()
+        cmd_plan = w_cmd_plan[cmd_file]
+    if cmd_plan is None:
+        if not os.path.exists(cmd_file):
+            print('[%s] %s:%s Error: %s does not exist.\n' % (w_time(), ip, port, cmd_file))
+        else:
+            print('[%s] %s:%s Error: %s is wrong.\n' % (w_time(), ip, port, cmd_file))
+    return cmd_plan
+
+
+
+def uf_the_end(f_out, ip, vendor, model, l2_uplink, cmd_all):
+
+    the_end = '''
+
+=======================================
+Device:     %s
+Vendor:     %s
+Model:      %s
+L2_Uplink:  %s
+Commands:   %s
+
+    \r\n''' % (ip, vendor, model, l2_uplink, cmd_all)
+    if f_out is None:
+        print(the_end)
+    else:
+        f_out.write(the_end)
+        f_out.close()
+
+
+
+def w_session(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeout, save, l2_sw, opt=None, hint=None):
+    #
+    # The session flow of both engines, run by w_main() or w_main_async().
+    #
+    # opt:  dict of the run-wide options, such as {'pacing': 'prompt'}
+    # hint: dict of what --host_file knows about this host, such as {'vendor': 'huawei'}
+    #
+    if opt is None:
+        opt = dict()
+    if hint is None:
+        hint = dict()
+    res = uf_result_init(ip, port)
+    ssh = None
+    try:
+        args = uf_init_args(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeout, save, l2_sw)
+        if args is None:
+            return uf_result_end(res, 'args')
+        port, cmd_plan, sleep_time, output_file, f_out, timeout, save, l2_sw = args
+        res['port'] = port
+        res['log'] = output_file
+        res['f_log'] = f_out
+
+        # Login - a retry waits for a turn of --login_rate / --group_rate, the
+        # first run of a host was admitted by uf_login_feed()
+        task = w_task_arg.get()
+        wait_time = uf_login_admit(ip, hint) if task is not None and task[1] > 0 else 0
+        if wait_time > 0:
+            uf_span(res, 'admit')
+            yield from uf_io(None, 'sleep', wait_time)
+
+        # Login - ssh
+        uf_span(res, 'spawn')
+        try:
+            ssh_cmd = uf_ssh_cmd(ip, port, uid, opt)
+            print('[%s] %s' % (w_time(), ssh_cmd))
+            ssh = yield from uf_io(None, 'spawn', ip, port, ssh_cmd)
+            uf_session_init(ssh, ip, port, opt)
+            uf_record_open(ssh, ip, port, pwd, ssh_cmd, res)
+            if w_replay_dir != '':
+                res['replay'] = ssh
+            if ssh.w_pacing == 'fixed':
+                yield from uf_io(None, 'sleep', sleep_time)
+        except Exception:
+            print('[%s] %s:%s Error: ssh failed' % (w_time(), ip, port))
+            return uf_result_end(res, 'ssh')
+        return (yield from w_session_run(ssh, ip, port, uid, pwd, cmd_prefix, cmd_plan, sleep_time, output_file, f_out, timeout, save, l2_sw, opt, hint, res))
+    except Exception as e:
+        # a bug of a step, or of a parser of its output: the host still gets its
+        # record, journal and retry decision, and its log is closed or archived
+        print('[%s] %s:%s Error: %s: %s' % (w_time(), ip, port, type(e).__name__, e))
+        if 'spans' in res:
+            return uf_result_end(res, 'exception')
         return False
-    idx, cmd_out = uf_expect_prompt(ssh, timeout, f_out)
+    finally:
+        # always release the pty and reap ssh, whichever way the session ended
+        if ssh is not None:
+            try:
+                yield from uf_io(ssh, 'close')
+            except Exception:
+                pass
+
+
+
+def w_session_run(ssh, ip, port, uid, pwd, cmd_prefix, cmd_plan, sleep_time, output_file, f_out, timeout, save, l2_sw, opt, hint, res):
+
+    uf_span(res, 'login')
+    if not (yield from uf_ssh_login(ssh, timeout, output_file, f_out, ip, port, uid, pwd, sleep_time)):
+        return uf_result_end(res, ssh.w_login_error)
+    uf_span(res, 'prompt')
+    idx, cmd_out = yield from uf_expect_prompt(ssh, timeout, f_out)
     if idx != 0:
-        return False
+        return uf_result_end(res, uf_prompt_error(cmd_out))
+    banner = uf_banner_digest(ssh.w_login_out + cmd_out, ssh.w_prompt)
+
+    # Known vendor goes to no-more directly
+    vendor, model = uf_vendor_known(ip, port, hint, opt, ssh.w_prompt, banner)
+    if vendor != '':
+        uf_span(res, 'nomore')
+        idx, cmd_out = yield from uf_set_nomore(ssh, timeout, f_out, sleep_time, vendor)
+        if idx == 1:
+            print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
+            return uf_result_end(res, 'timeout')
+        if uf_vendor_wrong(cmd_out):
+            print("[%s] %s:%s Warning: vendor %s is wrong, try to get it again." % (w_time(), ip, port, vendor))
+            vendor = ''
+        else:
+            uf_nomore_rejected(ssh, cmd_out)
 
-    # Get vendor and model
-    vendor, model = uf_get_vendor_model(ssh, timeout, f_out, sleep_time)
     if vendor == '':
-        print("[%s] %s:%s Error: can not get device vendor." % (w_time(), ip, port))
-        return False
-    if model == '':
-        print("[%s] %s:%s Error: can not get device type." % (w_time(), ip, port))
-        return False
+        # Get vendor and model
+        uf_span(res, 'vendor')
+        vendor, model = yield from uf_get_vendor_model(ssh, timeout, f_out, sleep_time)
+        if vendor == '':
+            print("[%s] %s:%s Error: can not get device vendor." % (w_time(), ip, port))
+            return uf_result_end(res, 'vendor')
+        if model == '':
+            print("[%s] %s:%s Error: can not get device type." % (w_time(), ip, port))
+            return uf_result_end(res, 'model')
+        uf_vendor_cache_set(ip, port, opt, vendor, model, ssh.w_prompt, banner)
+
+        # Set no-more
+        uf_span(res, 'nomore')
+        idx, cmd_out = yield from uf_set_nomore(ssh, timeout, f_out, sleep_time, vendor)
+        if idx == 1:
+            print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
+            return uf_result_end(res, 'timeout')
+        uf_nomore_rejected(ssh, cmd_out)
 
-    # Set no-more
-    idx, cmd_out = uf_set_nomore(ssh, timeout, f_out, sleep_time, vendor)
-    if idx == 1:
-        print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
-        return False
+    res['vendor'] = vendor
+    res['model'] = model
 
     # Get l2-uplink
     l2_uplink = ''
     if l2_sw == 'yes':
-        l2_uplink = uf_get_l2_uplink(ssh, timeout, f_out, sleep_time, vendor)
+        uf_span(res, 'l2_uplink')
+        l2_uplink = yield from uf_get_l2_uplink(ssh, timeout, f_out, sleep_time, vendor, opt)
 
     # if cmd_prefix was prefered.
-    if cmd_list is None:
-        cmd_prefix = '%s.cmd.%s' % (cmd_prefix, vendor)
-        if not os.path.exists(cmd_prefix):
-            print('[%s] %s:%s Error: %s does not exist.\n' % (w_time(), ip, port, cmd_prefix))
-            return False
-        f_cmd = open(cmd_prefix)
-        cmd_list = f_cmd.readlines()
-        f_cmd.close()
+    if cmd_plan is None:
+        cmd_plan = uf_get_cmd_plan(cmd_prefix, vendor, ip, port)
+        if cmd_plan is None:
+            return uf_result_end(res, 'cmd_prefix')
 
-    # Execute the command
+    # Execute the command, read-only commands may be pipelined (--pipeline)
+    ssh.w_stream = opt.get('stream', 'no') == 'yes'
     cmd_idx = 0
     cmd_all = ''
-    for i in range(0, len(cmd_list)):
+    cmd_first = 0                   # the first command run one by one, after --pipeline
+    if uf_pipeline_ok(ssh, opt, cmd_plan):
+        cmd_sent = [0]
+        for i in range(0, len(cmd_plan)):
+            cmd_idx = i + 2
+            cmd_line, cmd_timeout, cmd_prompt, cmd_error = cmd_plan[i]
+            uf_span(res, 'command', cmd_line)
+            yield from uf_parse_wait()
+            mark = uf_result_mark(f_out)
+            idx, cmd_out = yield from uf_expect_pipeline(ssh, timeout, f_out, cmd_plan, opt['pipeline'], i, cmd_sent)
+            if idx == 3:
+                # the pager, i and the rest are run again without --pipeline
+                break
+            cmd_all = '%s\n%s) %s' % (cmd_all, str(i+1).rjust(5), cmd_line)
+            cmd_first = i + 1
+            if idx == 0 and cmd_error is not None and cmd_error.search(cmd_out) is not None:
+                idx = 2
+            uf_result_cmd(res, f_out, i+1, cmd_line, idx, mark)
+            if idx == 2:
+                print("[%s] %s:%s Error: command %s failed." % (w_time(), ip, port, cmd_line))
+                return uf_result_end(res, 'cmd_error')
+            if idx != 0:
+                print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
+                return uf_result_end(res, 'timeout')
+    for i in range(cmd_first, len(cmd_plan)):
         cmd_idx = i + 2
-        cmd_line = cmd_list[i].strip()
+        cmd_line, cmd_timeout, cmd_prompt, cmd_error = cmd_plan[i]
         cmd_all = '%s\n%s) %s' % (cmd_all, str(i+1).rjust(5), cmd_line)
-        time.sleep(sleep_time)
+        uf_span(res, 'command', cmd_line)
+        if ssh.w_pacing == 'fixed':
+            yield from uf_io(None, 'sleep', sleep_time)
+        yield from uf_parse_wait()
+        mark = uf_result_mark(f_out)
+        ssh.w_step_prompt = cmd_prompt
         try:
-            idx, cmd_out = uf_expect_sendline(ssh, timeout, f_out, sleep_time, cmd_line)
+            idx, cmd_out = yield from uf_expect_sendline(ssh, cmd_timeout or timeout, f_out, sleep_time, cmd_line)
+            ssh.w_step_prompt = None
+            ssh.w_step_answer = idx == 0 and cmd_prompt is not None
+            if idx == 0 and cmd_error is not None and cmd_error.search(cmd_out) is not None:
+                idx = 2
+            uf_result_cmd(res, f_out, i+1, cmd_line, idx, mark)
+            if idx == 2:
+                print("[%s] %s:%s Error: command %s failed." % (w_time(), ip, port, cmd_line))
+                return uf_result_end(res, 'cmd_error')
             if idx == 1:
                 print("[%s] %s:%s Error: pexpect timed out." % (w_time(), ip, port))
-                return False
-        except:
-            print('\n[%s] %s:%s Error: command %s is failed to be executed.' % (w_time(), ip, port, cmd_list[i].strip()))
+                return uf_result_end(res, 'timeout')
+        except Exception:
+            ssh.w_step_prompt = None
+            uf_result_cmd(res, f_out, i+1, cmd_line, -1, mark)
+            print('\n[%s] %s:%s Error: command %s is failed to be executed.' % (w_time(), ip, port, cmd_line))
+
+    ssh.w_stream = False
 
     # Save config
     if save == 'yes':
         if timeout < 10:
             timeout = 10
-        idx, cmd_out = uf_save(ssh, timeout, f_out, sleep_time, vendor)
+        uf_span(res, 'save')
+        idx, cmd_out = yield from uf_save(ssh, timeout, f_out, sleep_time, vendor)
         cmd_all = '%s\n%s) %s' % (cmd_all, str(cmd_idx).rjust(5), '[Save Config]')
         if idx == 1:
             print("[%s] %s:%s Error: save config timed out." % (w_time(), ip, port))
-            return False
+            return uf_result_end(res, 'save_timeout')
         if idx == -1:
             print("[%s] %s:%s Error: save config failed." % (w_time(), ip, port))
 
     # Logout
-    uf_logout(ssh, timeout, f_out, sleep_time, vendor)
-    ssh.close()
-    the_end = '''
+    uf_span(res, 'logout')
+    yield from uf_logout(ssh, timeout, f_out, sleep_time, vendor)
+    uf_the_end(f_out, ip, vendor, model, l2_uplink, cmd_all)
+    res['l2_uplink'] = l2_uplink
 
-=======================================
-Device:     %s
-Vendor:     %s
-Model:      %s
-L2_Uplink:  %s
-Commands:   %s
+    return uf_result_end(res, '')
 
-    \r\n''' % (ip, vendor, model, l2_uplink, cmd_all)
-    if f_out is None:
-        print(the_end)
-    else:
-        f_out.write(the_end)
-        f_out.close()
+#___ End of w_session() ___
 
-    return True
+
+
+def uf_spawn(ip, port, ssh_cmd):
+
+    if w_replay_dir != '':
+        return ReplaySpawn(ip, port)
+    return pexpect.spawn(ssh_cmd, encoding='utf-8', codec_errors='replace')
+
+
+
+def w_drive(flow):
+    #
+    # Driver of the thread engine: each I/O yielded by uf_io() is a blocking
+    # call of pexpect.spawn, its result is sent back into the flow, or its
+    # exception is thrown into it.
+    #
+    reply = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                ssh, method, args, kwargs = flow.send(reply)
+            else:
+                ssh, method, args, kwargs = flow.throw(error)
+        except StopIteration as e:
+            return e.value
+        reply = None
+        error = None
+        try:
+            if method == 'sleep':
+                time.sleep(*args)
+            elif method == 'spawn':
+                reply = uf_spawn(*args)
+            elif method == 'read':
+                reply = ssh.read_nonblocking(ssh.maxread, *args)
+            else:
+                reply = getattr(ssh, method)(*args, **kwargs)
+        except Exception as e:
+            error = e
+
+
+
+def w_main(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeout, save, l2_sw, opt=None, hint=None):
+
+    # the thread engine, one blocking session of w_session() in each thread
+    return w_drive(w_session(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeout, save, l2_sw, opt, hint))
 
 #___ End of w_main() ___
 
 
 
+#
+#_________ asyncio engine (--engine asyncio) _________
+#
+# The same w_session() flow as above, its I/O is awaited by w_drive_async(),
+# and all sessions are driven by one event loop instead of one thread each.
+# AsyncSpawn reuses the pexpect Expecter, so before / after / buffer behave
+# exactly as they do with pexpect.spawn.
+#
+
+class AsyncSpawn(SpawnBase):
+
+    def __init__(self, timeout=30, maxread=2000, searchwindowsize=None):
+
+        SpawnBase.__init__(self, timeout, maxread, searchwindowsize, encoding='utf-8', codec_errors='replace')
+        self.child_fd = -1
+        self.proc = None
+        self.closed = True
+        self.w_data = list()
+        self.w_event = asyncio.Event()
+
+
+    async def start(self, cmd):
+
+        master, slave = pty.openpty()
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', 24, 80, 0, 0))
+        try:
+            # ssh reads the password from /dev/tty, the pty must be its controlling tty
+            self.proc = await asyncio.create_subprocess_exec(*cmd.split(),
+                            stdin=slave, stdout=slave, stderr=slave, start_new_session=True,
+                            preexec_fn=lambda: fcntl.ioctl(0, termios.TIOCSCTTY, 0))
+        except:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        self.child_fd = master
+        self.closed = False
+        self.name = '<%s>' % (cmd)
+        os.set_blocking(master, False)
+        asyncio.get_running_loop().add_reader(master, self.w_read)
+
+
+    def w_read(self):
+
+        try:
+            data = os.read(self.child_fd, self.maxread)
+        except OSError:
+            data = b''                  # EIO, the child has gone
+        if data:
+            s = self._decoder.decode(data, final=False)
+            self._log(s, 'read')
+            self.w_data.append(s)
+        else:
+            self.flag_eof = True
+            asyncio.get_running_loop().remove_reader(self.child_fd)
+        self.w_event.set()
+
+
+    def send(self, s):
+
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        b = self._encoder.encode(s, final=False)
+        return os.write(self.child_fd, b)
+
+
+    def sendline(self, s=''):
+
+        return self.send(s + self.linesep)
+
+
+    async def expect(self, pattern, timeout=-1, searchwindowsize=-1):
+
+        return await self.w_expect(searcher_re(self.compile_pattern_list(pattern)), timeout, searchwindowsize)
+
+
+    async def expect_exact(self, pattern_list, timeout=-1, searchwindowsize=-1):
+
+        pattern_list = [p if p in (pexpect.TIMEOUT, pexpect.EOF) else self._coerce_expect_string(p) for p in pattern_list]
+        return await self.w_expect(searcher_string(pattern_list), timeout, searchwindowsize)
+
+
+    async def w_expect(self, searcher, timeout, searchwindowsize):
+
+        if timeout == -1:
+            timeout = self.timeout
+        exp = Expecter(self, searcher, searchwindowsize)
+        idx = exp.existing_data()
+        if idx is not None:
+            return idx
+        end_time = time.time() + timeout
+        while True:
+            # Everything read so far is searched at once, like one read() of
+            # pexpect.spawn after the sleep in uf_expect_sendline().
+            if len(self.w_data) > 0:
+                data = ''.join(self.w_data)
+                self.w_data = list()
+                idx = exp.new_data(data)
+                if idx is not None:
+                    return idx
+            if self.flag_eof:
+                return exp.eof()
+            wait_time = end_time - time.time()
+            if wait_time <= 0:
+                return exp.timeout()
+            self.w_event.clear()
+            try:
+                await asyncio.wait_for(self.w_event.wait(), wait_time)
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def w_read_chunk(self, timeout):
+
+        # like read_nonblocking() of pexpect.spawn, everything read so far is returned at once
+        end_time = time.time() + timeout
+        while len(self.w_data) == 0:
+            if self.flag_eof:
+                raise pexpect.EOF('End Of File (EOF).')
+            wait_time = end_time - time.time()
+            if wait_time <= 0:
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            self.w_event.clear()
+            try:
+                await asyncio.wait_for(self.w_event.wait(), wait_time)
+            except asyncio.TimeoutError:
+                pass
+        data = ''.join(self.w_data)
+        self.w_data = list()
+        return data
+
+
+    async def close(self):
+
+        if self.child_fd != -1:
+            if not self.flag_eof:
+                asyncio.get_running_loop().remove_reader(self.child_fd)
+            os.close(self.child_fd)
+            self.child_fd = -1
+            self.closed = True
+        if self.proc is not None:
+            if self.proc.returncode is None:
+                try:
+                    self.proc.kill()
+                except ProcessLookupError:
+                    pass
+            await self.proc.wait()
+
+
+
+class AsyncReplaySpawn(AsyncSpawn):
+    #
+    # --replay of the asyncio engine: a task feeds the reads of the recording
+    # to w_data, as w_read() does with the pty, each one when the device would
+    # have sent it. A send that differs from the recording is EOF, as above.
+    #
+    def __init__(self, ip, port, timeout=30, maxread=2000, searchwindowsize=None):
+        AsyncSpawn.__init__(self, timeout, maxread, searchwindowsize)
+        self.w_event_list, self.w_send_list = uf_replay_load(ip, port)
+        self.w_pos = 0
+        self.w_sends = 0
+        self.w_mark = time.time()
+        self.w_diverged = ''
+        self.w_sent = asyncio.Event()
+        self.w_task = None
+
+    async def start(self, cmd):
+        self.closed = False
+        self.name = '<replay %s>' % (cmd)
+        self.w_mark = time.time()
+        self.w_task = asyncio.get_running_loop().create_task(self.w_feed())
+
+    async def w_feed(self):
+        while self.w_pos < len(self.w_event_list):
+            gate, delay, tag, text = self.w_event_list[self.w_pos]
+            while gate > self.w_sends and self.w_diverged == '':
+                self.w_sent.clear()
+                await self.w_sent.wait()
+            due = self.w_mark + uf_replay_delay(delay)
+            if due > time.time() and self.w_diverged == '':
+                await asyncio.sleep(due - time.time())
+            if self.w_diverged != '':
+                return
+            self.w_pos += 1
+            self.w_mark = due
+            if tag == 'e':
+                self.flag_eof = True
+            else:
+                self._log(text, 'read')
+                self.w_data.append(text)
+            self.w_event.set()
+            if self.flag_eof:
+                return
+
+    def send(self, s):
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        if self.w_diverged == '':
+            self.w_diverged = uf_replay_diverged(self.w_send_list, self.w_sends, s)
+            if self.w_diverged != '':
+                self.w_data = list()
+                self.flag_eof = True
+                self.w_event.set()
+        if self.w_pos < len(self.w_event_list) and self.w_event_list[self.w_pos][0] > self.w_sends:
+            self.w_mark = time.time()
+        self.w_sends += 1
+        self.w_sent.set()
+        return len(s)
+
+    async def close(self):
+        if self.w_task is not None:
+            self.w_task.cancel()
+            self.w_task = None
+        self.closed = True
+
+
+
+def w_asyncio(func_name, func_args, max_session, arg_block=False):
+
+    # the asyncio version of w_threading()
+    if func_name is None or func_name == '':
+        print('w_asyncio() error: func_name is empty.\n')
+        return False
+    if func_args is None or not hasattr(func_args, '__iter__'):
+        print('w_asyncio() error: func_args is wrong.\n')
+        return False
+    if not isinstance(max_session, int) or max_session <= 0:
+        max_session = 1000
+
+    # every session holds a pty master and a pidfd, lift the soft limit of open files
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    # Sliding window, same as w_threading(): max_session workers pull the next
+    # func_args as soon as their current session is done. With arg_block, as
+    # the generator of --precheck waits for its next reachable host, func_args
+    # is read by a thread, one worker at a time, not to block all sessions.
+    arg_iter = iter(func_args)
+    arg_busy = [0]
+    arg_lock = list()
+    arg_end = [False]
+
+    async def w_next():
+        if not arg_block:
+            return next(arg_iter, None)
+        async with arg_lock[0]:
+            if not arg_end[0]:
+                args = await asyncio.get_running_loop().run_in_executor(None, next, arg_iter, None)
+                arg_end[0] = args is None
+                return args
+        return None
+
+    async def w_worker():
+        while True:
+            args = await w_next()
+            if args is not None:
+                task = [args, 0, 0]
+            elif len(w_retry_queue) > 0:
+                task = w_retry_queue.popleft()
+            elif arg_busy[0] > 0:
+                # a running session could still requeue itself by w_requeue()
+                await asyncio.sleep(0.1)
+                continue
+            else:
+                break
+            arg_busy[0] += 1
+            w_task_arg.set(task)
+            try:
+                if task[2] > time.time():
+                    await asyncio.sleep(task[2] - time.time())
+                await func_name(*task[0])
+            except Exception as e:
+                print('[%s] w_asyncio() error: %s' % (w_time(), e))
+            arg_busy[0] -= 1
+
+    async def w_run():
+        # Reap ssh children with pidfd instead of the default one-thread-per-child watcher.
+        if sys.version_info < (3, 12) and hasattr(asyncio, 'PidfdChildWatcher'):
+            watcher = asyncio.PidfdChildWatcher()
+            watcher.attach_loop(asyncio.get_running_loop())
+            asyncio.set_child_watcher(watcher)
+        arg_lock.append(asyncio.Lock())
+        await asyncio.gather(*[w_worker() for i in range(0, max_session)])
+
+    asyncio.run(w_run())
+#___ End of w_asyncio() ____
+
+
+
+async def uf_spawn_async(ip, port, ssh_cmd):
+
+    if w_replay_dir != '':
+        ssh = AsyncReplaySpawn(ip, port)
+    else:
+        ssh = AsyncSpawn()
+    # nothing is read before the flow goes on, start() doesn't give the loop
+    # a turn once the pty reader is added, so --record sees it all
+    await ssh.start(ssh_cmd)
+    return ssh
+
+
+
+async def w_drive_async(flow):
+
+    # the asyncio version of w_drive(), I/O of the flow is awaited on AsyncSpawn
+    reply = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                ssh, method, args, kwargs = flow.send(reply)
+            else:
+                ssh, method, args, kwargs = flow.throw(error)
+        except StopIteration as e:
+            return e.value
+        reply = None
+        error = None
+        try:
+            if method == 'sleep':
+                await asyncio.sleep(*args)
+            elif method == 'spawn':
+                reply = await uf_spawn_async(*args)
+            elif method == 'read':
+                reply = await ssh.w_read_chunk(*args)
+            else:
+                reply = await getattr(ssh, method)(*args, **kwargs)
+        except Exception as e:
+            error = e
+
+
+
+async def w_main_async(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeout, save, l2_sw, opt=None, hint=None):
+
+    # the asyncio engine, all sessions of w_session() in one event loop
+    return await w_drive_async(w_session(ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, flt_timeout, save, l2_sw, opt, hint))
+
+#___ End of w_main_async() ___
+
+
+
+def w_host_parse(host_str):
+    #
+    # Yields [ip, port] of one host of --host or --host_file:
+    #
+    #       192.168.161.10              192.168.161.10:2222
+    #       192.168.161.0/24            192.168.161.0/24:2222       (hosts of the subnet)
+    #       192.168.161.10-20           192.168.161.10-192.168.162.5 (ranges, both ends included)
+    #       2001:db8::10                [2001:db8::10]:2222         [2001:db8::/120]:2222
+    #       sw-01.example.com           sw-01.example.com:2222
+    #
+    port = ''
+    if host_str.startswith('['):
+        addr, _, port = host_str[1:].partition(']')
+        port = port[1:]
+    elif host_str.count(':') == 1:
+        addr, port = host_str.split(':')
+    else:
+        addr = host_str
+    if port != '' and not port.isdigit():
+        raise ValueError('wrong port %s' % (port))
+    if addr.find('/') >= 0:
+        net = ipaddress.ip_network(addr, strict=False)
+        if net.num_addresses == 1:
+            yield [str(net.network_address), port]
+            return
+        for ip in net.hosts():
+            yield [str(ip), port]
+        return
+    ip_first, _, ip_last = addr.partition('-')
+    try:
+        ip_first = ipaddress.ip_address(ip_first)
+    except ValueError:
+        ip_last = ''                # a host name, such as sw-01.example.com
+    if ip_last != '':
+        if ip_last.find('.') < 0 and ip_last.find(':') < 0:
+            # 192.168.161.10-20, the last part of the first address only
+            ip_last = '%s%s' % (str(ip_first)[:str(ip_first).rfind('.') + 1], ip_last)
+        ip_last = ipaddress.ip_address(ip_last)
+        if ip_last.version != ip_first.version or ip_last < ip_first:
+            raise ValueError('wrong range %s' % (addr))
+        ip = ip_first
+        while ip <= ip_last:
+            yield [str(ip), port]
+            ip += 1
+        return
+    yield [addr, port]
+
+
+
+def w_host_list(host, host_file):
+    #
+    # Hosts of --host or --host_file are yielded as [ip, port, hint] one by
+    # one while the file is read, so that sessions start at once and the
+    # host list is never kept in memory. # starts a comment, and a host
+    # already yielded (same ip and port) is skipped.
+    #
+    if host != '':
+        host_rows = host.split(',')
+    else:
+        host_rows = open(host_file)
+    host_seen = set()
+    for host_row in host_rows:
+        # ip[:port] [vendor] [group]
+        host_row = host_row.split('#')[0].split()
+        if len(host_row) == 0:
+            continue
+        hint = dict()
+        if len(host_row) > 1 and host_row[1] != '-':
+            if host_row[1] in ['cisco', 'cisco_nexus', 'h3c', 'huawei']:
+                hint['vendor'] = host_row[1]
+            else:
+                print('Warning: unknown vendor %s of %s is ignored.' % (host_row[1], host_row[0]))
+        if len(host_row) > 2:
+            hint['group'] = host_row[2]
+        try:
+            for ip, port in w_host_parse(host_row[0]):
+                try:
+                    host_key = (int(ipaddress.ip_address(ip)), port or '22')
+                except ValueError:
+                    host_key = (ip.lower(), port or '22')
+                if host_key in host_seen:
+                    continue
+                host_seen.add(host_key)
+                yield [ip, port, hint]
+        except ValueError as e:
+            print('Warning: host %s is ignored, %s.' % (host_row[0], e))
+    if host == '':
+        host_rows.close()
+
+
+
+def uf_precheck(func_args, conn_timeout, max_conn):
+    #
+    # --precheck: ip:port of the hosts are probed by TCP connect from one
+    # thread, up to max_conn at the same time, and func_args of a host is
+    # yielded as soon as its connect is done, so the first sessions start
+    # while the rest are still probed and func_args is still read lazily.
+    # Unreachable hosts are reported at once and never take a session slot.
+    # A name is resolved by a pool of threads, not by the select loop, where
+    # a slow DNS would hold all the connects in flight. The select loop never
+    # waits for the sessions, or the deadline of a connect would run out
+    # while it waits: reachable hosts not taken yet count as connects in
+    # flight instead, so the probes are at most max_conn ahead of ssh.
+    #
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY:
+        max_conn = max(1, min(max_conn, soft - 64))
+    host_queue = queue.Queue()          # func_args of reachable hosts, None at the end
+
+    def uf_probe():
+        sel = selectors.DefaultSelector()
+        dns_pool = concurrent.futures.ThreadPoolExecutor(16)
+        dns_list = list()               # [func_args, future of getaddrinfo()]
+        arg_iter = iter(func_args)
+        arg_end = False
+        host_num = [0, 0]               # [hosts, reachable hosts]
+        try:
+            while True:
+                # more connects while there's room
+                while not arg_end and len(sel.get_map()) + len(dns_list) + host_queue.qsize() < max_conn:
+                    args = next(arg_iter, None)
+                    if args is None:
+                        arg_end = True
+                        break
+                    host_num[0] += 1
+                    try:
+                        addr = socket.getaddrinfo(args[0], int(args[1] or 22), type=socket.SOCK_STREAM,
+                                                  flags=socket.AI_NUMERICHOST)[0]
+                    except ValueError as e:
+                        uf_precheck_fail(args, e)
+                        continue
+                    except OSError:
+                        dns_list.append([args, dns_pool.submit(socket.getaddrinfo, args[0], int(args[1] or 22),
+                                                               type=socket.SOCK_STREAM)])
+                        continue
+                    try:
+                        uf_connect(sel, args, addr)
+                    except OSError as e:
+                        uf_precheck_fail(args, e)
+                # names resolved since the last round
+                for item in [item for item in dns_list if item[1].done()]:
+                    dns_list.remove(item)
+                    try:
+                        uf_connect(sel, item[0], item[1].result()[0])
+                    except OSError as e:
+                        uf_precheck_fail(item[0], e)
+                if arg_end and len(sel.get_map()) + len(dns_list) == 0:
+                    break
+                for key, mask in sel.select(timeout=0.1):
+                    uf_connect_done(sel, key, host_num)
+                now = time.time()
+                key_list = [key for key in sel.get_map().values() if key.data[1] <= now]
+                if len(key_list) > 0:
+                    # the last look, a connect done since the select above is not a timeout
+                    for key, mask in sel.select(timeout=0):
+                        uf_connect_done(sel, key, host_num)
+                for key in key_list:
+                    if key.fd in sel.get_map():
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                        uf_precheck_fail(key.data[0], 'timed out')
+            print('[%s] %s of %s hosts are reachable.' % (w_time(), host_num[1], host_num[0]))
+        finally:
+            sel.close()
+            dns_pool.shutdown(wait=False)
+            host_queue.put(None)
+
+    def uf_connect(sel, args, addr):
+        sock = socket.socket(addr[0], socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(addr[4])
+        sel.register(sock, selectors.EVENT_WRITE, [args, time.time() + conn_timeout])
+
+    def uf_connect_done(sel, key, host_num):
+        # a connect is done when the socket is writable, SO_ERROR tells how
+        sel.unregister(key.fileobj)
+        error = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        key.fileobj.close()
+        if error == 0:
+            host_num[1] += 1
+            host_queue.put(key.data[0])
+        else:
+            uf_precheck_fail(key.data[0], os.strerror(error))
+
+    threading.Thread(target=uf_probe, daemon=True).start()
+    while True:
+        args = host_queue.get()
+        if args is None:
+            break
+        yield args
+
+
+
+def uf_fd_check(max_session):
+    #
+    # A session holds a pty master, its log file, and a pidfd with asyncio, so
+    # the limit of open files is raised before the run, or the sessions are
+    # cut down to it, instead of ssh failing to spawn in the middle of it.
+    # Returns the number of sessions at the same time.
+    #
+    fd_need = max_session * 4 + 64
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= fd_need:
+        return max_session
+    if hard != resource.RLIM_INFINITY and hard < fd_need:
+        print('Warning: %s sessions need %s open files, but the limit is %s, sessions are cut down to %s.' % \
+              (max_session, fd_need, hard, max(1, (hard - 64) // 4)))
+        print('Raise the limit by ulimit -n, or use --workers to run more sessions.\n')
+        fd_need = hard
+        max_session = max(1, (hard - 64) // 4)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (fd_need, hard))
+    return max_session
+
+
+
+def uf_run(func_name, func_args, max_thread, engine, precheck):
+
+    global w_parse_pool, w_parse_room
+    if w_parse_list is not None:
+        # forked before the threads of the engine, a fork could copy a lock held by one of them
+        w_parse_pool = multiprocessing.get_context('fork').Pool(w_parse_proc)
+        w_parse_room = threading.Semaphore(w_parse_proc * 16)
+    if precheck > 0:
+        func_args = uf_precheck(func_args, precheck, 1000)
+    if w_history is not None:
+        func_args = uf_history_sort(func_args)
+    if w_login_rate > 0 or w_group_rate > 0:
+        func_args = uf_login_feed(func_args)
+    if engine == 'asyncio':
+        w_asyncio(func_name, func_args, max_thread, precheck > 0 and w_history is None or w_login_rate > 0 or w_group_rate > 0)
+    else:
+        w_threading(func_name, func_args, max_thread)
+    uf_parse_end()
+
+
+
+def uf_shard(args, workers):
+
+    # hosts of a group stay in one worker, so that --group_rate holds across workers
+    if w_group_rate > 0:
+        shard_key = uf_login_group(args[0], args[12] or dict())
+    else:
+        shard_key = '%s:%s' % (args[0], args[1] or '22')
+    return int(hashlib.md5(shard_key.encode()).hexdigest()[:8], 16) % workers
+
+
+
+def uf_run_worker(idx, workers, func_name, func_args, max_thread, engine, precheck, trace):
+    #
+    # --workers: a process of w_processing(), it runs the hosts of its shard
+    # with its own sessions, and returns what the parent merges: the time of
+    # phases (--timing), the vendor cache and the entries it deleted from it,
+    # and the history. Records of --result and --journal are appended to the
+    # shared files one line a write.
+    #
+    global w_login_rate, w_trace_file, w_trace_pid
+    w_login_rate = w_login_rate / workers
+    if w_result_file is not None:
+        w_result_file.reconfigure(line_buffering=True)
+    if w_trace_file is not None:
+        w_trace_file = open('%s.%s' % (trace, idx), 'w')
+        w_trace_pid = idx + 1
+        w_trace_file.write(',\n%s' % (json.dumps({'name': 'process_name', 'ph': 'M', 'pid': w_trace_pid, 'args': {'name': 'w-sw-ssh.py worker %s' % (idx)}})))
+    uf_run(func_name, (args for args in func_args if uf_shard(args, workers) == idx), max_thread, engine, precheck)
+    if w_trace_file is not None:
+        w_trace_file.close()
+    uf_archive_close()
+    return {'span_time': w_span_time, 'vendor_cache': w_vendor_cache, 'vendor_cache_del': w_vendor_cache_del, 'history': w_history}
+
+
+
+def uf_run_merge(res_list, trace):
+
+    # what the processes of --workers returned, see uf_run_worker()
+    for res in res_list:
+        # an entry deleted by a worker (expired, banner or prompt changed, or
+        # no vendor) is gone, unless a worker set it again, merged below
+        if res is not None:
+            for host_key in res['vendor_cache_del']:
+                w_vendor_cache.pop(host_key, None)
+    for res in res_list:
+        if res is None:
+            continue
+        for span_key in res['span_time']:
+            w_span_time.setdefault(span_key, list()).extend(res['span_time'][span_key])
+        for host_key in res['vendor_cache']:
+            cache = res['vendor_cache'][host_key]
+            if host_key not in w_vendor_cache or w_vendor_cache[host_key].get('time', 0) < cache.get('time', 0):
+                w_vendor_cache[host_key] = cache
+            elif w_vendor_cache[host_key].get('l2_time', 0) < cache.get('l2_time', 0):
+                # the uplink learned on a host whose vendor came from the cache
+                for cache_key in ['gw_ip', 'gw_mac', 'l2_uplink', 'l2_time']:
+                    w_vendor_cache[host_key][cache_key] = cache[cache_key]
+        for host_key in res['history'] or dict():
+            host = res['history'][host_key]
+            if host_key not in w_history or w_history[host_key]['time'] < host['time']:
+                w_history[host_key] = host
+    if w_trace_file is None:
+        return
+    for idx in range(0, len(res_list)):
+        try:
+            with open('%s.%s' % (trace, idx)) as f_part:
+                w_trace_file.write(f_part.read())
+            os.remove('%s.%s' % (trace, idx))
+        except OSError:
+            pass
+
+
+
+def uf_precheck_fail(args, error):
+
+    ip = args[0]
+    port = args[1] or '22'
+    print('[%s] %s:%s Error: TCP connect failed, %s.' % (w_time(), ip, port, error))
+    res = uf_result_init(ip, port)
+    uf_result_end(res, 'unreachable')
+
+
+
+
 if __name__ == '__main__':
 
     host = ''
@@ -703,9 +3552,37 @@ if __name__ == '__main__':
     timeout = 10
     save = 'no'
     l2_sw = 'no'
+    engine = 'thread'
+    pacing = 'fixed'
+    vendor_cache = ''
+    vendor_cache_ttl = 604800
+    ssh_mux = ''
+    ssh_persist = 600
+    pipeline = 0
+    stream = 'no'
+    result = ''
+    timing = 'no'
+    retry = 0
+    retry_wait = 30
+    journal = ''
+    resume = 'no'
+    trace = ''
+    precheck = 0
+    login_rate = 0
+    group_rate = 0
+    workers = 1
+    archive = ''
+    store = ''
+    parse = ''
+    parse_dir = ''
+    parse_format = 'jsonl'
+    history = ''
+    record = ''
+    replay = ''
+    replay_speed = 1.0
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hp", ['uid=','pwd=','host=','host_file=','cmd=','cmd_prefix=','cmd_interval=','log_dir=','thread=','timeout=','save','l2_sw'])
+        opts, args = getopt.getopt(sys.argv[1:], "hp", ['uid=','pwd=','host=','host_file=','cmd=','cmd_prefix=','cmd_interval=','log_dir=','thread=','timeout=','save','l2_sw','engine=','pacing=','vendor_cache=','vendor_cache_ttl=','ssh_mux=','ssh_persist=','pipeline=','stream','result=','timing','trace=','retry=','retry_wait=','journal=','resume','precheck=','login_rate=','group_rate=','workers=','archive=','store=','parse=','parse_dir=','parse_format=','history=','record=','replay=','replay_speed='])
     except:
         print("Wrong options!")
         print("Try '-h' to get more information.")
@@ -750,10 +3627,36 @@ if __name__ == '__main__':
         elif op == '--log_dir':
             log_dir = value
 
+        elif op == '--archive':
+            archive = value
+
+        elif op == '--store':
+            store = value
+
+        elif op == '--parse':
+            parse = value
+
+        elif op == '--parse_dir':
+            parse_dir = value
+
+        elif op == '--parse_format':
+            if value not in ['jsonl', 'csv']:
+                print('Wrong option: --parse_format only accepts jsonl or csv.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+            parse_format = value
+
         elif op == '--thread':
             if value.isalnum():
                 thread = int(value)
 
+        elif op == '--workers':
+            if not value.isdigit() or int(value) == 0:
+                print('Wrong option: --workers only accepts a positive integer value.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+            workers = int(value)
+
         elif op == '--timeout':
             try:
                 timeout = float(value)
@@ -768,46 +3671,279 @@ if __name__ == '__main__':
         elif op == '--l2_sw':
             l2_sw = 'yes'
 
+        elif op == '--engine':
+            if value not in ['thread', 'asyncio']:
+                print('Wrong option: --engine only accepts thread or asyncio.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+            engine = value
+
+        elif op == '--pacing':
+            if value not in ['fixed', 'prompt']:
+                print('Wrong option: --pacing only accepts fixed or prompt.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+            pacing = value
+
+        elif op == '--vendor_cache':
+            vendor_cache = value
+
+        elif op == '--vendor_cache_ttl':
+            try:
+                vendor_cache_ttl = float(value)
+            except ValueError:
+                print('Wrong option: --vendor_cache_ttl only accepts a float value.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+
+        elif op == '--ssh_mux':
+            ssh_mux = value
+
+        elif op == '--ssh_persist':
+            if not value.isdigit():
+                print('Wrong option: --ssh_persist only accepts an integer value.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+            ssh_persist = int(value)
+
+        elif op == '--retry':
+            if not value.isdigit():
+                print('Wrong option: --retry only accepts an integer value.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+            retry = int(value)
+
+        elif op == '--retry_wait':
+            try:
+                retry_wait = float(value)
+            except ValueError:
+                print('Wrong option: --retry_wait only accepts a number.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+
+        elif op == '--journal':
+            journal = value
+
+        elif op == '--history':
+            history = value
+
+        elif op == '--resume':
+            resume = 'yes'
+
+        elif op == '--record':
+            record = value
+
+        elif op == '--replay':
+            replay = value
+
+        elif op == '--replay_speed':
+            try:
+                replay_speed = float(value)
+            except ValueError:
+                print('Wrong option: --replay_speed only accepts a float value.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+
+        elif op == '--precheck':
+            try:
+                precheck = float(value)
+            except ValueError:
+                print('Wrong option: --precheck only accepts a float value.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+
+        elif op == '--login_rate':
+            try:
+                login_rate = float(value)
+            except ValueError:
+                print('Wrong option: --login_rate only accepts a float value.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+
+        elif op == '--group_rate':
+            try:
+                group_rate = float(value)
+            except ValueError:
+                print('Wrong option: --group_rate only accepts a float value.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+
+        elif op == '--timing':
+            timing = 'yes'
+
+        elif op == '--trace':
+            trace = value
+
+        elif op == '--result':
+            result = value
+
+        elif op == '--stream':
+            stream = 'yes'
+
+        elif op == '--pipeline':
+            if not value.isdigit():
+                print('Wrong option: --pipeline only accepts an integer value.')
+                print("Try '-h' to get more information.")
+                sys.exit(1)
+            pipeline = int(value)
+
         else:
             help_and_exit()
 
+    if stream == 'yes' and log_dir == '' and archive == '':
+        print('Wrong option: --stream needs --log_dir or --archive.')
+        print("Try '-h' to get more information.")
+        sys.exit(1)
+    if parse != '' and parse_dir == '':
+        print('Wrong option: --parse needs --parse_dir.')
+        print("Try '-h' to get more information.")
+        sys.exit(1)
+    if archive != '' and log_dir != '':
+        print('Wrong option: --archive is instead of --log_dir.')
+        print("Try '-h' to get more information.")
+        sys.exit(1)
+    if resume == 'yes' and journal == '':
+        print('Wrong option: --resume needs --journal.')
+        print("Try '-h' to get more information.")
+        sys.exit(1)
+    if record != '' and replay != '':
+        print('Wrong option: --record and --replay can not be used together.')
+        print("Try '-h' to get more information.")
+        sys.exit(1)
+    if replay != '' and precheck > 0:
+        print('Wrong option: --precheck connects to the devices, it can not be used with --replay.')
+        print("Try '-h' to get more information.")
+        sys.exit(1)
+    if replay != '' and not os.path.isdir(replay):
+        print('Wrong option: --replay %s is not a directory.' % (replay))
+        print("Try '-h' to get more information.")
+        sys.exit(1)
+
     #__________ multi-thread __________
 
     # func_name
     func_name = w_main
+    if engine == 'asyncio':
+        func_name = w_main_async
+
+    opt = {'pacing': pacing, 'vendor_cache': vendor_cache, 'vendor_cache_ttl': vendor_cache_ttl, 'pipeline': pipeline, 'stream': stream}
+    if vendor_cache != '':
+        uf_vendor_cache_load(vendor_cache)
+    if history != '':
+        uf_history_load(history)
+    if result != '':
+        try:
+            w_result_file = open(result, 'a')
+        except:
+            print('%s is failed to open, please check --result.\n' % (result))
+            sys.exit(1)
+    if trace != '':
+        try:
+            w_trace_file = open(trace, 'w')
+            w_trace_file.write('{"traceEvents": [\n%s' % (json.dumps({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'w-sw-ssh.py'}})))
+        except:
+            print('%s is failed to open, please check --trace.\n' % (trace))
+            sys.exit(1)
+    w_span_on = timing == 'yes' or trace != ''
+    w_retry_max = retry
+    w_login_rate = login_rate
+    w_group_rate = group_rate
+    w_retry_wait = retry_wait
+    host_done = set()
+    if resume == 'yes':
+        host_done = uf_journal_load(journal)
+        print('%s hosts done in %s are skipped.' % (len(host_done), journal))
+    if journal != '':
+        try:
+            w_journal_file = open(journal, 'a')
+        except:
+            print('%s is failed to open, please check --journal.\n' % (journal))
+            sys.exit(1)
+    if archive != '':
+        try:
+            os.makedirs(archive, exist_ok=True)
+        except OSError:
+            print('%s is failed to create, please check --archive.\n' % (archive))
+            sys.exit(1)
+        w_archive_dir = archive
+    if record != '':
+        try:
+            os.makedirs(record, exist_ok=True)
+        except OSError:
+            print('%s is failed to create, please check --record.\n' % (record))
+            sys.exit(1)
+        w_record_dir = record
+    w_replay_dir = replay
+    w_replay_speed = replay_speed
+    if store != '':
+        # a manifest of each run, the blobs are shared by all runs
+        try:
+            os.makedirs('%s/objects' % (store), exist_ok=True)
+            os.makedirs('%s/manifest' % (store), exist_ok=True)
+            w_store_file = open('%s/manifest/%s.%s.jsonl' % (store, w_time('%Y%m%d%H%M%S'), os.getpid()), 'a')
+        except OSError:
+            print('%s is failed to create, please check --store.\n' % (store))
+            sys.exit(1)
+        w_store_dir = store
+    if parse != '':
+        w_parse_list = uf_parse_load(parse)
+        if w_parse_list is None:
+            sys.exit(1)
+        try:
+            os.makedirs(parse_dir, exist_ok=True)
+        except OSError:
+            print('%s is failed to create, please check --parse_dir.\n' % (parse_dir))
+            sys.exit(1)
+        w_parse_dir = parse_dir
+        w_parse_format = parse_format
+        w_parse_proc = max(1, (os.cpu_count() or 2) // (2 * workers))
+    if ssh_mux != '':
+        # sockets of other users' connections must not be reachable
+        try:
+            os.makedirs(ssh_mux, mode=0o700, exist_ok=True)
+        except OSError:
+            print('%s is failed to create, please check --ssh_mux.\n' % (ssh_mux))
+            sys.exit(1)
+        opt['ssh_mux'] = ssh_mux
+        opt['ssh_persist'] = ssh_persist
 
-    # func_args
-    func_args = list()
-
-    host_list = list()
     print('')
-    if host != '':
-        host_list = host.split(',')
-    elif host_file != '':
-        if not os.path.exists(host_file):
-            print('%s does not exist, please specify host with --host or --host_file.\n' % (host_file))
-            help_and_exit()
-
-        f_host = open(host_file)
-        host_list = f_host.readlines()
-        f_host.close()
-    else:
+    if host == '' and host_file == '':
         print('Please specify host with --host or --host_file.\n')
         help_and_exit()
+    if host == '' and not os.path.exists(host_file):
+        print('%s does not exist, please specify host with --host or --host_file.\n' % (host_file))
+        help_and_exit()
 
-    host_len = len(host_list)
-    for i in range(0, host_len):
-        if host_list[i].find(':') >= 0:
-            ip, port = host_list[i].split(':')
-            ip = ip.strip()
-            port = port.strip()
-        else:
-            ip = host_list[i].strip()
-            port = ''
-        func_args.append([ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, timeout, save, l2_sw])
-
-    # Start multi-threading
-    w_threading(func_name, func_args, thread)
+    # a generator, w_threading() and w_asyncio() take hosts as they go
+    func_args = ([ip, port, uid, pwd, cmd, cmd_prefix, cmd_interval, log_dir, timeout, save, l2_sw, opt, hint]
+                 for ip, port, hint in w_host_list(host, host_file)
+                 if '%s:%s' % (ip, port or '22') not in host_done)
+    # Start multi-threading, in each process of --workers
+    thread = uf_fd_check(-(-thread // workers))
+    if workers > 1:
+        if w_trace_file is not None:
+            w_trace_file.flush()
+        res_list = w_processing(uf_run_worker, [workers, func_name, func_args, thread, engine, precheck, trace], workers)
+        uf_run_merge(res_list, trace)
+    else:
+        uf_run(func_name, func_args, thread, engine, precheck)
+    if vendor_cache != '' and replay == '':
+        uf_vendor_cache_save(vendor_cache)
+    if history != '':
+        uf_history_save(history)
+    uf_archive_close()
+    if w_store_file is not None:
+        w_store_file.close()
+    if w_result_file is not None:
+        w_result_file.close()
+    if w_journal_file is not None:
+        w_journal_file.close()
+    if w_trace_file is not None:
+        w_trace_file.write('\n]}\n')
+        w_trace_file.close()
+    if timing == 'yes':
+        uf_span_summary()
 
     # exit
     print('')